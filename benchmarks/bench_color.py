@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""
+compass_to_rgb と ColorLUT を比較する benchmark.
+変換速度と, 解像度ごとの最大の色の誤差 (0-255) を表示する.
+
+    PYTHONPATH=. python3 benchmarks/bench_color.py [--samples 100000] [--number 100000]
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from linux_thermaltake_rgb_plus.color import ColorLUT, hsv_to_grb
+from linux_thermaltake_rgb_plus.lighting_manager import compass_to_rgb
+
+RESOLUTIONS = [(90, 9, 9), (360, 17, 17), (360, 33, 33), (720, 65, 65)]
+
+
+def max_error(lut, h, s, v):
+    expected = np.array([compass_to_rgb(*hsv) for hsv in zip(h, s, v)], dtype=np.int64)
+    actual = lut.lookup_many(h, s, v).astype(np.int64)
+    return int(np.abs(expected - actual).max())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    h = rng.uniform(0, 360, args.samples)
+    s = rng.uniform(0, 1, args.samples)
+    v = rng.uniform(0, 1, args.samples)
+
+    print('max color error over random hsv')
+    for resolution in RESOLUTIONS:
+        lut = ColorLUT(*resolution)
+        print(f'  hue/sat/val steps {str(resolution):<16} {lut.table.nbytes:>9} B '
+              f'max error {max_error(lut, h, s, v)}')
+
+    lut = ColorLUT()
+    hue_lut = ColorLUT(sat_steps=1, val_steps=1)
+    print(f'\nscalar ({args.number} calls)')
+    cases = [
+        ('compass_to_rgb(h)', lambda: compass_to_rgb(123.4)),
+        ('ColorLUT.lookup(h) hue only', lambda: hue_lut.lookup(123.4)),
+        ('compass_to_rgb(h, s, v)', lambda: compass_to_rgb(123.4, 0.5, 0.7)),
+        ('ColorLUT.lookup(h, s, v)', lambda: lut.lookup(123.4, 0.5, 0.7)),
+    ]
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=args.number)
+        print(f'  {name:<32} {seconds / args.number * 1e9:10.1f} ns/call')
+
+    n = 80 * 12
+    hb, sb, vb = h[:n], s[:n], v[:n]
+    number = max(args.number // 1000, 10)
+    print(f'\nbatch of {n} leds ({number} frames)')
+    cases = [
+        ('[compass_to_rgb(...)]', lambda: [compass_to_rgb(*hsv) for hsv in zip(hb, sb, vb)]),
+        ('hsv_to_grb', lambda: hsv_to_grb(hb, sb, vb)),
+        ('ColorLUT.lookup_many', lambda: lut.lookup_many(hb, sb, vb)),
+    ]
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=number)
+        print(f'  {name:<32} {seconds / number * 1e6:10.1f} us/frame')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+"""
+simulated transport で daemon を動かし, control socket の 1 request の往復時間を command ごとに測る.
+同時に fan tick が deadline からどれだけ遅れたかを見て, request が manager の loop を止めていないか確かめる.
+config は一時ディレクトリに書いた最小のもの (numpy もセンサもいらない) を使う.
+
+    PYTHONPATH=. python3 benchmarks/bench_control.py [--requests 200] [--json control.json]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = '''\
+controllers:
+  - unit: 1
+    type: g3
+    devices:
+      1: Riing Plus
+      2: Riing Plus
+      3: Riing Plus
+  - unit: 2
+    type: g3
+    devices:
+      1: Riing Plus
+      2: Riing Plus
+watch_config: false
+control:
+  path: {path}
+fan_managers:
+  - setting: default
+    model: locked_speed
+    speed: 50
+lighting_manager:
+  - setting: default
+    model: full
+    r: 40
+    g: 0
+    b: 0
+'''
+REQUESTS = {
+    'status': lambda i: {'cmd': 'status'},
+    'fan': lambda i: {'cmd': 'fan', 'device': '1:2', 'speed': 30 + i % 50},
+    'fan_model': lambda i: {'cmd': 'fan_model', 'setting': 'default', 'model': 'locked_speed',
+                            'speed': 40 + i % 20},
+    'lighting_effect': lambda i: {'cmd': 'lighting_effect', 'setting': 'default',
+                                  'model': 'full', 'r': i % 40, 'g': 0, 'b': 0},
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def measure(sock, reader, make_request, n):
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        sock.sendall(json.dumps(make_request(i)).encode() + b'\n')
+        reply = json.loads(reader.readline())
+        times.append(time.perf_counter() - start)
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    os.environ['LINUX_THERMALTAKE_RGB_PLUS_TRANSPORT'] = 'simulated'
+    sys.path.insert(0, REPO)
+    from linux_thermaltake_rgb_plus.daemon.daemon import ThermaltakeDaemon
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'control.sock')
+        assets = os.path.join(directory, 'linux_thermaltake_rgb_plus', 'assets')
+        os.makedirs(assets)
+        with open(os.path.join(assets, 'config.yml'), 'w') as f:
+            f.write(CONFIG.format(path=path))
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            daemon = ThermaltakeDaemon()
+        finally:
+            os.chdir(cwd)
+        daemon.run()
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            reader = sock.makefile('rb')
+            results = []
+            for command, make_request in REQUESTS.items():
+                times = measure(sock, reader, make_request, args.requests)
+                results.append({'command': command,
+                                'p50_ms': statistics.median(times) * 1000,
+                                'p99_ms': percentile(times, 0.99) * 1000,
+                                'max_ms': max(times) * 1000})
+            sock.close()
+            clock = daemon.fan_managers['default']._task.clock
+            lateness_ms = clock.mean_lateness * 1000
+        finally:
+            daemon.stop()
+
+    print(f'{"command":<16} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for result in results:
+        print(f'{result["command"]:<16} {result["p50_ms"]:8.3f} {result["p99_ms"]:8.3f} '
+              f'{result["max_ms"]:8.3f}')
+    print(f'fan tick mean lateness {lateness_ms:.3f} ms')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version, 'requests': args.requests, 'results': results,
+                       'fan_tick_lateness_ms': lateness_ms}, f, indent=2)
+        print(f'wrote {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+"""
+simulated transport 上で controller, device, manager を実際に動かし, lighting effect ごと,
+device 数ごとに daemon の hot path を測る. 実機も温度センサもいらない.
+    encode_us: 1 frame 分の lighting packet を組み立てる時間
+    render_us: effect が全 device の 1 frame を作ってキューに入れるまでの時間
+    fps: scheduler 上で実際に出た frame 数 / 秒 (周期的な effect のみ)
+    writes/s/ctrl: controller 1 台あたりの USB 書き込み数 / 秒
+    lateness: frame と fan tick が deadline からどれだけ遅れたか (loop の jitter)
+    fan tick: FanManager の 1 tick (温度の読み出し, model, 書き込みのキュー) にかかる時間
+    stream は visualizer の代わりに StreamSender が全ての device の frame を fps で socket に送る.
+    render_us は受信スレッドが受け取った 1 frame 分を device に渡すまでの時間
+    cpu %, rss: プロセス全体の CPU 使用率と常駐メモリ
+
+結果は --json で機械可読な形で書き出せるので, 変更の前後で比べられる.
+
+    PYTHONPATH=. python3 benchmarks/bench_daemon.py [--devices 5 10 20 40 80] [--duration 2]
+        [--effects thermal wave ...] [--latency 0.001] [--jitter 0.0005] [--json results.json]
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+import timeit
+from threading import Event, Thread
+
+import psutil
+
+from linux_thermaltake_rgb_plus import transport
+from linux_thermaltake_rgb_plus.controllers import ThermaltakeController
+from linux_thermaltake_rgb_plus.devices import ThermaltakeDevice
+from linux_thermaltake_rgb_plus.drivers import PacketEncoder
+from linux_thermaltake_rgb_plus.fan_manager import FanModel, FanManager
+from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS
+from linux_thermaltake_rgb_plus.lighting_manager import LightingEffect, LightingManager
+from linux_thermaltake_rgb_plus.lighting_manager import StreamLightingEffect
+from linux_thermaltake_rgb_plus.lighting_manager import ThreadedCustomLightingEffect
+from linux_thermaltake_rgb_plus.scheduler import Scheduler
+from linux_thermaltake_rgb_plus.sensors import sensor_service
+
+PORTS = 5
+DEVICE_MODEL = 'Riing Plus'
+GRBS = [[40, 0, 0], [30, 10, 0], [20, 20, 0], [10, 30, 0], [0, 40, 0], [0, 30, 10],
+        [0, 20, 20], [0, 10, 30], [0, 0, 40], [10, 0, 30], [20, 0, 20], [30, 0, 10]]
+EFFECTS = {
+    'thermal': {'cold': 30, 'hot': 65, 'target': 45, 'sensor_name': 'simulated'},
+    'alternating': {'odd_rgb': {'r': 40, 'g': 0, 'b': 0}, 'even_rgb': {'r': 0, 'g': 0, 'b': 40}},
+    'full': {'r': 40, 'g': 40, 'b': 0},
+    'off-light': {},
+    'per-led': {'grbs': GRBS},
+    'flow': {'speed': 'extreme'},
+    'spectrum': {'speed': 'extreme'},
+    'ripple': {'speed': 'extreme', 'r': 40, 'g': 40, 'b': 0},
+    'blink': {'speed': 'extreme', 'grbs': GRBS},
+    'pulse': {'speed': 'extreme', 'grbs': GRBS},
+    'wave': {'speed': 'extreme', 'grbs': GRBS},
+    # path は run_case で一時ディレクトリに作る
+    'stream': {'timeout': 1.0},
+}
+
+
+class DriftingSensor:
+    """
+    30°C から 70°C の間を period 秒でゆっくり往復する温度センサ. sensor backend として使う.
+    """
+
+    def __init__(self, period=20.0):
+        self.period = period
+        self._start = time.monotonic()
+
+    def subscribe(self, sensor_name):
+        return True
+
+    def read(self, sensor_names):
+        phase = (time.monotonic() - self._start) / self.period * 2 * math.pi
+        return {name: 50.0 + 20.0 * math.sin(phase) for name in sensor_names}
+
+    def close(self):
+        pass
+
+
+class StreamSender:
+    """
+    stream effect の socket に全ての device の frame を送る. start() すると fps で送り続ける.
+    dedup で送られない frame が出ないよう, 送るたびに色を 1 LED ずつずらす.
+    """
+
+    def __init__(self, path, devices, fps):
+        self.path = path
+        self.period = 1.0 / fps
+        self.frames = [[bytes([int(dev.controller.unit), int(dev.port)])
+                        + bytes(sum((GRBS[i:] + GRBS[:i]) * dev.num_leds, [])[:3 * dev.num_leds])
+                        for dev in devices]
+                       for i in range(len(GRBS))]
+        self._sent = 0
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._stop = Event()
+        self._thread = None
+
+    def send(self):
+        for frame in self.frames[self._sent % len(self.frames)]:
+            self._socket.sendto(frame, self.path)
+        self._sent += 1
+
+    def send_and_wait(self, effect):
+        """
+        1 frame 分を送り, 受信スレッドが全て受け取るまで待つ.
+        """
+        self.send()
+        while True:
+            with effect._lock:
+                if len(effect._back) == len(self.frames[0]):
+                    return
+            time.sleep(0.0001)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='stream-sender', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.send()
+            deadline += self.period
+            self._stop.wait(max(0.0, deadline - time.monotonic()))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._socket.close()
+
+
+class Rig:
+    """
+    simulated transport の controller を devices 個の fan に足りるだけ用意する.
+    """
+
+    def __init__(self, devices):
+        self.controllers = []
+        self.devices = []
+        for unit in range(1, math.ceil(devices / PORTS) + 1):
+            controller = ThermaltakeController.factory('g3', unit)
+            for port in range(1, PORTS + 1):
+                if len(self.devices) == devices:
+                    break
+                dev = ThermaltakeDevice.factory(DEVICE_MODEL)
+                controller.attach_device(port, dev)
+                self.devices.append(dev)
+            self.controllers.append(controller)
+
+    def usb_writes(self):
+        return sum(controller.driver.transport.writes for controller in self.controllers)
+
+    def drain(self):
+        for controller in self.controllers:
+            controller.io.call(lambda: None).result(30)
+
+    def invalidate(self):
+        for dev in self.devices:
+            dev.invalidate_frame()
+
+    def stop(self):
+        for controller in self.controllers:
+            controller.stop()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def measure_encode(number):
+    encoder = PacketEncoder()
+    values = bytes(sum(GRBS, []))
+    seconds = timeit.timeit(
+        lambda: encoder.encode_lighting(1, TT_RGB_PLUS.RGB_MODE.PER_LED, values), number=number)
+    return seconds / number * 1e6
+
+
+def measure_render(effect, rig, number, before=None):
+    """
+    dedup で送られない frame が出ないよう, 毎回 frame を無効にしてから 1 frame 作る.
+    before は時間に含めない準備 (stream では frame の受信).
+    """
+    render = effect.next if isinstance(effect, ThreadedCustomLightingEffect) else effect.start
+    elapsed = 0.0
+    for _ in range(number):
+        rig.invalidate()
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        render()
+        elapsed += time.perf_counter() - start
+    rig.drain()
+    return elapsed / number * 1e6
+
+
+def run_case(name, rig, args, process):
+    config = dict(EFFECTS[name], model=name)
+    directory = tempfile.mkdtemp() if name == 'stream' else None
+    if directory is not None:
+        config['path'] = os.path.join(directory, 'stream.sock')
+    effect = LightingEffect.factory(config)
+    if isinstance(effect, ThreadedCustomLightingEffect):
+        effect._speed = 1.0 / args.fps
+    effect.set_devices(rig.devices)
+
+    sender = None
+    if isinstance(effect, StreamLightingEffect):
+        effect.begin_all()
+        sender = StreamSender(effect.path, rig.devices, args.fps)
+        render_us = measure_render(effect, rig, args.renders,
+                                   before=lambda: sender.send_and_wait(effect))
+        # manager の start() でもう一度 socket を開く
+        effect.stop()
+    else:
+        render_us = measure_render(effect, rig, args.renders)
+
+    scheduler = Scheduler()
+    lighting_manager = LightingManager(effect, name, scheduler)
+    fan_manager = FanManager(FanModel.factory({'model': 'temp_target', 'target': 45,
+                                               'sensor_name': 'simulated'}),
+                             'bench', scheduler)
+    fan_manager.tick_interval = fan_manager.interval = 1.0 / args.fan_rate
+    for dev in rig.devices:
+        lighting_manager.attach_device(dev)
+        fan_manager.attach_device(dev)
+
+    tick_times = []
+    tick = fan_manager._tick
+
+    def timed_tick():
+        start = time.perf_counter()
+        tick()
+        tick_times.append(time.perf_counter() - start)
+    fan_manager._tick = timed_tick
+
+    rig.invalidate()
+    writes = rig.usb_writes()
+    cpu = process.cpu_times()
+    start = time.monotonic()
+
+    scheduler.start()
+    lighting_manager.start()
+    fan_manager.start()
+    if sender is not None:
+        sender.start()
+    time.sleep(args.duration)
+    lighting_clock = getattr(effect, 'frame_clock', None)
+    fan_clock = fan_manager._task.clock
+    if sender is not None:
+        sender.stop()
+    lighting_manager.stop()
+    fan_manager.stop()
+    scheduler.stop()
+    rig.drain()
+    if directory is not None:
+        os.rmdir(directory)
+
+    wall = time.monotonic() - start
+    cpu_end = process.cpu_times()
+    cpu_seconds = (cpu_end.user - cpu.user) + (cpu_end.system - cpu.system)
+
+    return {
+        'effect': name,
+        'devices': len(rig.devices),
+        'controllers': len(rig.controllers),
+        'render_us': render_us,
+        'fps': lighting_clock.frames / wall if lighting_clock else None,
+        'frame_lateness_mean_ms': lighting_clock.mean_lateness * 1000 if lighting_clock else None,
+        'frame_lateness_max_ms': lighting_clock.max_lateness * 1000 if lighting_clock else None,
+        'usb_writes_per_controller_s': (rig.usb_writes() - writes) / len(rig.controllers) / wall,
+        'fan_ticks': len(tick_times),
+        'fan_tick_mean_us': sum(tick_times) / len(tick_times) * 1e6 if tick_times else None,
+        'fan_tick_p99_us': percentile(tick_times, 0.99) * 1e6,
+        'fan_lateness_mean_ms': fan_clock.mean_lateness * 1000,
+        'fan_lateness_max_ms': fan_clock.max_lateness * 1000,
+        'cpu_percent': cpu_seconds / wall * 100,
+        'rss_mb': process.memory_info().rss / 2 ** 20,
+    }
+
+
+def fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, nargs='+', default=[5, 10, 20, 40, 80])
+    parser.add_argument('--effects', nargs='+', default=list(EFFECTS), choices=list(EFFECTS))
+    parser.add_argument('--duration', type=float, default=2.0)
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--fan-rate', type=float, default=10.0, help='fan ticks per second')
+    parser.add_argument('--renders', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.001)
+    parser.add_argument('--jitter', type=float, default=0.0005)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    transport.configure({'backend': 'simulated', 'latency': args.latency,
+                         'jitter': args.jitter, 'seed': 0})
+    sensor_service.set_backend(DriftingSensor())
+    process = psutil.Process()
+
+    encode_us = measure_encode(100000)
+    print(f'encode {encode_us:.2f} us/packet, usb latency {args.latency * 1000:.2f} ms '
+          f'+ jitter {args.jitter * 1000:.2f} ms, {args.fps:.0f} fps, '
+          f'{args.fan_rate:.0f} fan ticks/s, {args.duration:.1f}s per case')
+    print(f'{"effect":<12} {"devs":>4} {"render us":>10} {"fps":>6} {"writes/s/ctrl":>13} '
+          f'{"lateness ms":>12} {"fan tick us":>12} {"fan late ms":>12} {"cpu %":>6} '
+          f'{"rss MB":>7}')
+
+    results = []
+    for devices in args.devices:
+        rig = Rig(devices)
+        for name in args.effects:
+            result = run_case(name, rig, args, process)
+            results.append(result)
+            print(f'{name:<12} {devices:>4} {result["render_us"]:10.1f} '
+                  f'{fmt(result["fps"], "6.1f"):>6} '
+                  f'{result["usb_writes_per_controller_s"]:13.1f} '
+                  f'{fmt(result["frame_lateness_max_ms"], "12.2f"):>12} '
+                  f'{fmt(result["fan_tick_mean_us"], "12.1f"):>12} '
+                  f'{result["fan_lateness_max_ms"]:12.2f} {result["cpu_percent"]:6.1f} '
+                  f'{result["rss_mb"]:7.1f}')
+        rig.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': sys.version,
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'args': vars(args),
+                'encode_us': encode_us,
+                'results': results,
+            }, f, indent=2)
+        print(f'wrote {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+"""
+簡単な熱モデル (CPU + ヒートシンク) に対して fan model を動かし,
+負荷が変わってから目標温度に収束するまでの時間と fan への書き込み回数を比べる.
++policy は FanWritePolicy を使った場合.
+USB もセンサも使わない.
+
+    PYTHONPATH=. python3 benchmarks/bench_fan_models.py [--duration 900] [--noise 0.5]
+"""
+import argparse
+import random
+
+from linux_thermaltake_rgb_plus.fan_manager import FanModel, FanWritePolicy
+from linux_thermaltake_rgb_plus.sensors import sensor_service
+
+SENSOR_NAME = 'simulated'
+
+
+class ThermalPlant:
+    """
+    C dT/dt = P - G(fan) (T - T_ambient),  G(fan) = g_idle + g_fan * fan / 100
+    センサは 1°C 単位で, noise °C の正規分布の雑音がのる. sensor backend として使える.
+    """
+
+    def __init__(self, noise=0.5, ambient=25.0, capacity=150.0, g_idle=1.5, g_fan=4.5, seed=0):
+        self.temp = ambient
+        self.ambient = ambient
+        self.capacity = capacity
+        self.g_idle = g_idle
+        self.g_fan = g_fan
+        self.noise = noise
+        self.power = 30.0
+        self._random = random.Random(seed)
+
+    def step(self, fan, dt):
+        conductance = self.g_idle + self.g_fan * fan / 100.0
+        self.temp += (self.power - conductance * (self.temp - self.ambient)) / self.capacity * dt
+
+    def subscribe(self, sensor_name):
+        return True
+
+    def read(self, sensor_names):
+        return {SENSOR_NAME: float(round(self.temp + self._random.gauss(0, self.noise)))}
+
+    def close(self):
+        pass
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(config, duration, noise, target, policy=None, dt=1.0, load_step_at=60.0,
+             power=150.0):
+    plant = ThermalPlant(noise=noise)
+    sensor_service.set_backend(plant)
+    model = FanModel.factory(dict(config, sensor_name=SENSOR_NAME))
+    clock = SimulatedClock()
+    if hasattr(model, 'clock'):
+        model.clock = clock
+    # FanManager と同じく, policy が許したときだけ書き込む
+    policy = FanWritePolicy.from_config(policy or {})
+    policy.clock = clock
+
+    speed = 0
+    settled_at = None
+    peak = 0.0
+    t = 0.0
+    while t < duration:
+        if t >= load_step_at:
+            plant.power = power
+        clock.now = t
+        sensor_service.sample()
+        new_speed = policy.apply(model.main(), model.last_temp)
+        if new_speed is not None:
+            speed = new_speed
+        plant.step(speed, dt)
+
+        if t >= load_step_at:
+            peak = max(peak, plant.temp)
+            if abs(plant.temp - target) <= 1.0:
+                if settled_at is None:
+                    settled_at = t
+            else:
+                settled_at = None
+        t += dt
+
+    settle = None if settled_at is None else settled_at - load_step_at
+    return settle, policy.writes, policy.saved, peak, plant.temp
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=900)
+    parser.add_argument('--noise', type=float, default=0.5)
+    parser.add_argument('--target', type=float, default=60)
+    args = parser.parse_args()
+
+    write_policy = {'deadband': 2, 'max_slew': 10, 'min_interval': 3, 'emergency_temp': 85}
+    models = [
+        ('temp_target', {'model': 'temp_target', 'target': args.target, 'multiplier': 5}, None),
+        ('temp_target+policy', {'model': 'temp_target', 'target': args.target, 'multiplier': 5},
+         write_policy),
+        ('pid', {'model': 'pid', 'target': args.target}, None),
+        ('pid+policy', {'model': 'pid', 'target': args.target}, write_policy),
+    ]
+
+    print(f'load step 30W -> 150W at t=60s, target {args.target}°C, '
+          f'sensor noise {args.noise}°C, {args.duration:.0f}s')
+    print(f'{"model":<20} {"settle (s)":>10} {"writes":>8} {"saved":>8} {"peak °C":>8} '
+          f'{"final °C":>9}')
+    for name, config, policy in models:
+        settle, writes, saved, peak, final = simulate(config, args.duration, args.noise,
+                                                      args.target, policy)
+        settle = '-' if settle is None else f'{settle:.0f}'
+        print(f'{name:<20} {settle:>10} {writes:>8} {saved:>8} {peak:8.1f} {final:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
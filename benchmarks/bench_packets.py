@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+"""
+1 frame 分の lighting packet を組み立てるコストを比較する microbenchmark.
+これまでの list を作る方法と, PacketEncoder で 64 byte のバッファを使い回す方法を比べる.
+
+    PYTHONPATH=. python3 benchmarks/bench_packets.py [--leds 12] [--number 100000]
+"""
+import argparse
+import timeit
+import tracemalloc
+
+from linux_thermaltake_rgb_plus.drivers import PacketEncoder
+from linux_thermaltake_rgb_plus.globals import PROTOCOL_SET, PROTOCOL_LIGHT, TT_RGB_PLUS
+
+
+def list_path(port, mode, values):
+    """
+    これまでの ThermaltakeRGBDevice.set_lighting と _populate_partial_data_array の処理.
+    """
+    data = [PROTOCOL_SET, PROTOCOL_LIGHT, port, mode]
+    if values:
+        data.extend(values)
+    array = list(data)
+    array.extend([0x00 for _ in range(len(data))])
+    return array
+
+
+def count_peak(func):
+    """
+    func を 1 回呼んだときに一時的に確保されるメモリの最大量を返す.
+    """
+    func()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--leds', type=int, default=12)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    values = [0x40, 0x10, 0x00] * args.leds
+    values_bytes = bytes(values)
+    encoder = PacketEncoder()
+    mode = TT_RGB_PLUS.RGB_MODE.PER_LED
+
+    cases = [
+        ('list path', lambda: list_path(1, mode, values)),
+        ('PacketEncoder (list payload)', lambda: encoder.encode_lighting(1, mode, values)),
+        ('PacketEncoder (bytes payload)', lambda: encoder.encode_lighting(1, mode, values_bytes)),
+    ]
+
+    assert list(encoder.encode_lighting(1, mode, values)[:4 + len(values)]) \
+        == list_path(1, mode, values)[:4 + len(values)]
+
+    print(f'{args.leds} leds, {args.number} frames')
+    print(f'{"":<32} {"ns/frame":>10} {"allocated B/frame":>18}')
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=args.number)
+        print(f'{name:<32} {seconds / args.number * 1e9:10.1f} {count_peak(func):18d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+"""
+scheduler 上で FanManager を実際に動かし, 温度が落ち着いている区間と急に上がる区間で
+fan tick (scheduler の wakeup) と温度センサの走査が何回起きたかを数える.
+    fixed-fast: polling なし, 常に min_interval 秒ごとの tick
+    fixed: polling なし, tick_interval 秒ごとの tick
+    adaptive: polling あり (min_interval から max_interval の間で変わる)
+センサは定期的には読まれず, tick が get_temp したときに snapshot が古ければ読まれる.
+USB は simulated transport の代わりに書き込みを数えるだけの device を使う.
+
+    PYTHONPATH=. python3 benchmarks/bench_polling.py [--steady 6] [--ramp 2] [--json polling.json]
+"""
+import argparse
+import json
+import sys
+import time
+
+from linux_thermaltake_rgb_plus.fan_manager import FanModel, FanManager
+from linux_thermaltake_rgb_plus.scheduler import Scheduler
+from linux_thermaltake_rgb_plus.sensors import sensor_service
+
+SENSOR_NAME = 'simulated'
+POLLING = {'min_interval': 0.05, 'max_interval': 1.0, 'rate_high': 2.0, 'rate_low': 0.2}
+
+
+class StepSensor:
+    """
+    steady 秒は 40°C, 次の ramp 秒で 70°C まで上がり, その後は 70°C のまま.
+    """
+
+    def __init__(self, steady, ramp):
+        self.steady = steady
+        self.ramp = ramp
+        self._start = time.monotonic()
+
+    def temp(self):
+        t = time.monotonic() - self._start - self.steady
+        return 40.0 + 30.0 * min(max(t / self.ramp, 0.0), 1.0)
+
+    def subscribe(self, sensor_name):
+        return True
+
+    def read(self, sensor_names):
+        return {name: self.temp() for name in sensor_names}
+
+    def close(self):
+        pass
+
+
+class CountingFan:
+    def __init__(self):
+        self.writes = 0
+
+    def set_fan_speed(self, speed, future=None):
+        self.writes += 1
+
+
+def run_case(name, polling, tick_interval, args):
+    sensor_service.set_backend(StepSensor(args.steady, args.ramp))
+    reads = sensor_service.reads
+    scheduler = Scheduler()
+    model = FanModel.factory({'model': 'temp_target', 'target': 45, 'sensor_name': SENSOR_NAME})
+    manager = FanManager(model, name, scheduler)
+    manager.tick_interval = manager.interval = tick_interval
+    if polling:
+        manager.configure({'polling': polling})
+    fan = CountingFan()
+    manager.attach_device(fan)
+
+    phases = {}
+    scheduler.start()
+    manager.start()
+    clock = manager._task.clock
+    for phase, duration in (('steady', args.steady), ('ramp', args.ramp),
+                            ('settled', args.steady)):
+        ticks, reads_before = clock.frames, sensor_service.reads
+        time.sleep(duration)
+        phases[phase] = {'ticks': clock.frames - ticks,
+                         'sensor_reads': sensor_service.reads - reads_before}
+    manager.stop()
+    scheduler.stop()
+
+    return {
+        'case': name,
+        'phases': phases,
+        'ticks': clock.frames,
+        'sensor_reads': sensor_service.reads - reads,
+        'fan_writes': fan.writes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steady', type=float, default=6.0)
+    parser.add_argument('--ramp', type=float, default=2.0)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    cases = [('fixed-fast', None, POLLING['min_interval']),
+             ('fixed', None, FanManager.tick_interval),
+             ('adaptive', POLLING, POLLING['min_interval'])]
+    results = [run_case(name, polling, tick_interval, args)
+               for name, polling, tick_interval in cases]
+
+    print(f'{args.steady:.0f}s at 40°C, {args.ramp:.0f}s ramp to 70°C, {args.steady:.0f}s at 70°C')
+    print(f'{"case":<12} {"wakeups":>8} {"reads":>6}  per phase (wakeups/reads)')
+    for result in results:
+        phases = '  '.join(f'{phase} {item["ticks"]}/{item["sensor_reads"]}'
+                           for phase, item in result['phases'].items())
+        print(f'{result["case"]:<12} {result["ticks"]:>8} {result["sensor_reads"]:>6}  {phases}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version, 'args': vars(args), 'polling': POLLING,
+                       'results': results}, f, indent=2)
+        print(f'wrote {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""
+simulated transport で daemon を動かし, config.yml を書き換えて reload_config() にかかる時間を測る.
+同時に, 壊れた項目 (存在しない fan model, lighting effect, bind できない stream socket) を
+書いた reload では動いている manager がそのまま残ることを確かめる.
+config は一時ディレクトリに書いた最小のもの (numpy もセンサもいらない) を使う.
+
+    PYTHONPATH=. python3 benchmarks/bench_reload.py [--repeat 20] [--json reload.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = '''\
+controllers:
+  - unit: 1
+    type: g3
+    devices:
+      1: Riing Plus
+      2: Riing Plus
+      3: Riing Plus
+watch_config: false
+fan_managers:
+  - setting: back
+    devices: {{1: [1, 2]}}
+    model: {fan_model}
+    speed: {speed}
+  - setting: default
+    model: locked_speed
+    speed: 50
+lighting_manager:
+  - setting: default
+    model: {effect}
+{effect_settings}
+'''
+GOOD = {'fan_model': 'locked_speed', 'effect': 'full',
+        'effect_settings': '    r: 40\n    g: 0\n    b: 0'}
+# 動いている manager を残さなければならない reload
+BROKEN = {
+    'unknown fan model': dict(GOOD, fan_model='nonexistent'),
+    'unknown lighting effect': dict(GOOD, effect='fulll'),
+    # 前の manager を止めるまで分からない失敗 (start で socket を bind できない)
+    'unbindable stream socket': dict(GOOD, effect='stream',
+                                     effect_settings='    path: /proc/nonexistent/stream.sock'),
+}
+
+
+def write_config(directory, speed=40, **settings):
+    with open(os.path.join(directory, 'linux_thermaltake_rgb_plus', 'assets', 'config.yml'),
+              'w') as f:
+        f.write(CONFIG.format(speed=speed, **dict(GOOD, **settings)))
+
+
+def running(daemon):
+    # reload の前後で比べられるよう, 動いている manager とその model を集める
+    return {(kind, setting_name): (manager, manager.current_model,
+                                   getattr(manager, '_task', None) is not None
+                                   or getattr(manager, 'running', False))
+            for kind, managers in (('fan', daemon.fan_managers),
+                                   ('lighting', daemon.lighting_managers))
+            for setting_name, manager in managers.items()}
+
+
+def reload(daemon, directory):
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        start = time.perf_counter()
+        daemon.reload_config()
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    os.environ['LINUX_THERMALTAKE_RGB_PLUS_TRANSPORT'] = 'simulated'
+    sys.path.insert(0, REPO)
+    from linux_thermaltake_rgb_plus.daemon.daemon import ThermaltakeDaemon
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, 'linux_thermaltake_rgb_plus', 'assets'))
+        write_config(directory)
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            daemon = ThermaltakeDaemon()
+        finally:
+            os.chdir(cwd)
+        daemon.run()
+        try:
+            # 変わった fan manager 1 つだけを作り直す reload
+            times = []
+            for i in range(args.repeat):
+                write_config(directory, speed=41 + i % 50)
+                times.append(reload(daemon, directory))
+
+            # 壊れた項目以外は最後の reload と同じ config にする
+            speed = 41 + (args.repeat - 1) % 50
+            kept = {}
+            for case, settings in BROKEN.items():
+                before = running(daemon)
+                write_config(directory, speed=speed, **settings)
+                reload(daemon, directory)
+                kept[case] = running(daemon) == before
+        finally:
+            daemon.stop()
+
+    print(f'reload of one changed fan manager: p50 {statistics.median(times) * 1000:.3f} ms, '
+          f'max {max(times) * 1000:.3f} ms')
+    for case, ok in kept.items():
+        print(f'{case:<28} {"kept the running managers" if ok else "REPLACED the running managers"}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version, 'repeat': args.repeat,
+                       'p50_ms': statistics.median(times) * 1000, 'max_ms': max(times) * 1000,
+                       'kept': kept}, f, indent=2)
+        print(f'wrote {args.json}')
+    if not all(kept.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+"""
+温度センサの読み出しコストを比較する benchmark.
+偽の /sys/class/hwmon ツリーを作って実行するので, 実際のセンサは不要.
+
+    PYTHONPATH=. python3 benchmarks/bench_sensors.py [--hwmons 8] [--temps 16] [--number 2000]
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import timeit
+from unittest import mock
+
+import psutil
+import psutil._pslinux
+
+from linux_thermaltake_rgb_plus.sensors import HwmonSensorBackend, PsutilSensorBackend
+
+REAL_HWMON_ROOT = '/sys/class/hwmon'
+
+
+def make_fake_hwmon(root, hwmons, temps):
+    """
+    hwmon0 を coretemp, 残りを適当なデバイスとした偽の sysfs ツリーを作る.
+    """
+    for i in range(hwmons):
+        hwmon_dir = os.path.join(root, f'hwmon{i}')
+        os.makedirs(hwmon_dir)
+        with open(os.path.join(hwmon_dir, 'name'), 'w') as f:
+            f.write('coretemp\n' if i == 0 else f'dummy{i}\n')
+        for t in range(1, temps + 1):
+            base = os.path.join(hwmon_dir, f'temp{t}')
+            with open(base + '_input', 'w') as f:
+                f.write(f'{40000 + t * 1000}\n')
+            with open(base + '_label', 'w') as f:
+                f.write('Package id 0\n' if t == 1 else f'Core {t - 2}\n')
+            with open(base + '_max', 'w') as f:
+                f.write('80000\n')
+            with open(base + '_crit', 'w') as f:
+                f.write('100000\n')
+
+
+def make_temp_root():
+    """
+    psutil は path を '_' で区切って扱うので, '_' を含まない一時ディレクトリを作る.
+    """
+    while True:
+        root = tempfile.mkdtemp(prefix='hwmon')
+        if '_' not in root:
+            return root
+        os.rmdir(root)
+
+
+def redirect_glob(root):
+    """
+    psutil は /sys/class/hwmon を決め打ちで glob するので, 偽のツリーに向け直す.
+    """
+    real_glob = glob.glob
+
+    def fake_glob(pattern, *args, **kwargs):
+        if pattern.startswith(REAL_HWMON_ROOT):
+            return real_glob(root + pattern[len(REAL_HWMON_ROOT):], *args, **kwargs)
+        if pattern.startswith('/sys/'):
+            return []
+        return real_glob(pattern, *args, **kwargs)
+
+    return mock.patch.object(psutil._pslinux.glob, 'glob', fake_glob)
+
+
+def report(name, seconds, number):
+    print(f'{name:<40} {seconds / number * 1e6:10.2f} us/read')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hwmons', type=int, default=8)
+    parser.add_argument('--temps', type=int, default=16)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    root = make_temp_root()
+    try:
+        with redirect_glob(root):
+            run(root, args)
+    finally:
+        shutil.rmtree(root)
+
+
+def run(root, args):
+    make_fake_hwmon(root, args.hwmons, args.temps)
+    print(f'fake hwmon tree: {args.hwmons} hwmons x {args.temps} temps')
+
+    # これまでの _get_temp と同じ読み方
+    def get_temp():
+        return psutil.sensors_temperatures().get('coretemp')[0].current
+
+    psutil_backend = PsutilSensorBackend()
+    hwmon_backend = HwmonSensorBackend(root=root)
+    hwmon_backend.subscribe('coretemp')
+    assert hwmon_backend.read(['coretemp']) == psutil_backend.read(['coretemp'])
+
+    report('sensors_temperatures()[0].current',
+           timeit.timeit(get_temp, number=args.number), args.number)
+    report('PsutilSensorBackend.read',
+           timeit.timeit(lambda: psutil_backend.read(['coretemp']), number=args.number),
+           args.number)
+    report('HwmonSensorBackend.read (pread)',
+           timeit.timeit(lambda: hwmon_backend.read(['coretemp']), number=args.number),
+           args.number)
+    hwmon_backend.close()
+
+
+if __name__ == '__main__':
+    main()
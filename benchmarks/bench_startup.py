@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+"""
+daemon の起動にかかる時間を新しいプロセスで測る.
+    import: python -X importtime で見た, daemon の module を import するまでの時間と重い module の内訳
+    construct: simulated transport で ThermaltakeDaemon() を作り終えるまでの時間
+    loaded: 起動し終えた時点で読み込まれていた重い module (lazy_import されただけのものは含まない)
+config はリポジトリの config.yml と, numpy を使う model を含まない最小の config の 2 つで測る.
+
+    PYTHONPATH=. python3 benchmarks/bench_startup.py [--repeat 5] [--json startup.json]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ('numpy', 'psutil', 'yaml', 'usb')
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MINIMAL_CONFIG = '''\
+controllers:
+  - unit: 1
+    type: g3
+    devices:
+      1: Riing Plus
+      2: Riing Plus
+watch_config: false
+fan_managers:
+  - setting: default
+    model: locked_speed
+    speed: 50
+lighting_manager:
+  - setting: default
+    model: full
+    r: 40
+    g: 0
+    b: 0
+'''
+
+CONSTRUCT = '''\
+import json, sys, time, types
+start = time.perf_counter()
+from linux_thermaltake_rgb_plus.daemon.daemon import ThermaltakeDaemon
+imported = time.perf_counter()
+daemon = ThermaltakeDaemon()
+constructed = time.perf_counter()
+for controller in daemon.controllers.values():
+    controller.stop()
+print(json.dumps({'import_s': imported - start, 'construct_s': constructed - imported,
+                  'loaded': [name for name in %r
+                             if type(sys.modules.get(name)) is types.ModuleType]}))
+''' % (HEAVY_MODULES,)
+
+
+def environ():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    env['LINUX_THERMALTAKE_RGB_PLUS_TRANSPORT'] = 'simulated'
+    env.pop('LINUX_THERMALTAKE_RGB_PLUS_PROFILE', None)
+    return env
+
+
+def importtime(cwd):
+    """
+    -X importtime の出力から, 重い module と daemon 全体の累積時間 (秒) を取り出す.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import linux_thermaltake_rgb_plus.daemon.daemon'],
+        cwd=cwd, env=environ(), capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)', line)
+        if match:
+            cumulative[match.group(3)] = int(match.group(1)) / 1e6
+    return {name: cumulative.get(name) for name in
+            HEAVY_MODULES + ('linux_thermaltake_rgb_plus.daemon.daemon',)}
+
+
+def construct(cwd):
+    result = subprocess.run([sys.executable, '-c', CONSTRUCT], cwd=cwd, env=environ(),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure(name, cwd, repeat):
+    runs = [construct(cwd) for _ in range(repeat)]
+    return {
+        'config': name,
+        'import_s': statistics.median(run['import_s'] for run in runs),
+        'construct_s': statistics.median(run['construct_s'] for run in runs),
+        'loaded': runs[-1]['loaded'],
+        'importtime': importtime(cwd),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as minimal:
+        assets = os.path.join(minimal, 'linux_thermaltake_rgb_plus', 'assets')
+        os.makedirs(assets)
+        with open(os.path.join(assets, 'config.yml'), 'w') as f:
+            f.write(MINIMAL_CONFIG)
+        results = [measure('repository', REPO, args.repeat),
+                   measure('minimal', minimal, args.repeat)]
+
+    print(f'{"config":<12} {"import ms":>10} {"construct ms":>13}  loaded')
+    for result in results:
+        print(f'{result["config"]:<12} {result["import_s"] * 1000:10.1f} '
+              f'{result["construct_s"] * 1000:13.1f}  {", ".join(result["loaded"])}')
+    print('importtime (cumulative ms, at import of the daemon module)')
+    for result in results:
+        times = ', '.join(f'{name.split(".")[-1]} {"-" if t is None else f"{t * 1000:.1f}"}'
+                          for name, t in result['importtime'].items())
+        print(f'  {result["config"]:<12} {times}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version, 'repeat': args.repeat, 'results': results}, f,
+                      indent=2)
+        print(f'wrote {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,21 +7,38 @@ DEBUG = bool(os.environ.get('DEBUG', False))
 
 
 class ClassifiedObject:
+    """
+    subclass は定義された時点で全ての祖先の registry に登録される.
+    factory は lookup() で model 名から class を引く.
+    """
+    _inheritors = set()
+    _models = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._inheritors = set()
+        cls._models = None
+        for base in cls.__mro__[1:]:
+            if '_inheritors' in base.__dict__:
+                base._inheritors.add(cls)
+                # 次の lookup() で作り直す
+                base._models = None
 
     @classmethod
     def inheritors(cls):
-        subclasses = set()
-        work = [cls]
-        while work:
-            parent = work.pop()
+        return set(cls._inheritors)
 
-            for child in parent.__subclasses__():
-                if child not in subclasses:
-                    print(child.__name__)
-                    subclasses.add(child)
-                    work.append(child)
-
-        return subclasses
+    @classmethod
+    def lookup(cls, model: str):
+        """
+        model 名 (大文字小文字は区別しない) の subclass を返す. なければ None.
+        """
+        models = cls._models
+        if models is None:
+            models = cls._models = {clazz.__dict__['model'].lower(): clazz
+                                    for clazz in cls._inheritors
+                                    if clazz.__dict__.get('model') is not None}
+        return models.get(model.lower())
 
 
 class Model(ClassifiedObject):
@@ -34,14 +51,27 @@ class Model(ClassifiedObject):
 
 
 class Manager(ClassifiedObject):
-    def __init__(self, initial_model: Model = None, name: str = None):
+    _model = None
+
+    def __init__(self, initial_model: Model = None, name: str = None, scheduler=None):
         self._name = name
         self._devices = []
+        self._scheduler = scheduler
         self.set_model(initial_model)
 
+    @property
+    def current_model(self) -> Model:
+        return self._model
+
     def attach_device(self, device):
         self._devices.append(device)
 
+    def configure(self, config: dict):
+        """
+        config.yml の manager の項目から manager 自身の設定を読む.
+        """
+        pass
+
     def set_model(self, model: Model):
         raise NotImplementedError
 
@@ -0,0 +1,86 @@
+from linux_thermaltake_rgb_plus.util import lazy_import
+
+np = lazy_import('numpy')
+
+
+def hsv_to_grb(h, s=1.0, v=1.0) -> 'np.ndarray':
+    """
+    lighting_manager.compass_to_rgb の vectorized 版.
+    :param h: 色相 (度). スカラーまたは配列
+    :param s: 彩度 [0, 1]
+    :param v: 明度 [0, 1]
+    :return: (..., 3) の uint8 配列 (g, r, b)
+    """
+    h, s, v = np.broadcast_arrays(np.asarray(h, dtype=np.float64),
+                                  np.asarray(s, dtype=np.float64),
+                                  np.asarray(v, dtype=np.float64))
+    h_60 = h / 60.0
+    h_60f = np.floor(h_60)
+    hi = h_60f.astype(np.int64) % 6
+    f = h_60 - h_60f
+
+    p = v * (1 - s)
+    q = v * (1 - f * s)
+    t = v * (1 - (1 - f) * s)
+
+    r = np.choose(hi, (v, q, p, p, t, v))
+    g = np.choose(hi, (t, v, v, q, p, p))
+    b = np.choose(hi, (p, p, t, v, v, q))
+
+    # compass_to_rgb と同じく int() と同じ切り捨てにする
+    return (np.stack((g, r, b), axis=-1) * 255).astype(np.uint8)
+
+
+class ColorLUT:
+    """
+    色相, 彩度, 明度を量子化した (g, r, b) の lookup table.
+    hue_steps は 360 度を何分割するか, sat_steps, val_steps は [0, 1] を何段階にするか.
+    1 段階の場合は 1.0 に固定される.
+    """
+
+    def __init__(self, hue_steps: int = 360, sat_steps: int = 33, val_steps: int = 33):
+        if min(hue_steps, sat_steps, val_steps) < 1:
+            raise ValueError('LUT resolution must be at least 1')
+        self.hue_steps = hue_steps
+        self.sat_steps = sat_steps
+        self.val_steps = val_steps
+
+        h = np.arange(hue_steps) * (360.0 / hue_steps)
+        s = self._levels(sat_steps)
+        v = self._levels(val_steps)
+        self.table = hsv_to_grb(h[:, None, None], s[None, :, None], v[None, None, :])
+        self._cache = {}
+
+    @staticmethod
+    def _levels(steps):
+        if steps == 1:
+            return np.ones(1)
+        return np.linspace(0.0, 1.0, steps)
+
+    def _index(self, h, s, v):
+        i = int(h * self.hue_steps / 360.0 + 0.5) % self.hue_steps
+        j = int(s * (self.sat_steps - 1) + 0.5) if self.sat_steps > 1 else 0
+        k = int(v * (self.val_steps - 1) + 0.5) if self.val_steps > 1 else 0
+        return i, j, k
+
+    def lookup(self, h, s=1.0, v=1.0) -> tuple:
+        """
+        compass_to_rgb と同じく (g, r, b) の tuple を返す.
+        """
+        index = self._index(h, s, v)
+        grb = self._cache.get(index)
+        if grb is None:
+            grb = self._cache[index] = tuple(self.table[index].tolist())
+        return grb
+
+    def lookup_many(self, h, s=1.0, v=1.0) -> 'np.ndarray':
+        """
+        lookup の vectorized 版. (..., 3) の uint8 配列を返す.
+        """
+        h, s, v = np.broadcast_arrays(np.asarray(h, dtype=np.float64),
+                                      np.asarray(s, dtype=np.float64),
+                                      np.asarray(v, dtype=np.float64))
+        i = np.floor(h * (self.hue_steps / 360.0) + 0.5).astype(np.intp) % self.hue_steps
+        j = np.floor(s * (self.sat_steps - 1) + 0.5).astype(np.intp)
+        k = np.floor(v * (self.val_steps - 1) + 0.5).astype(np.intp)
+        return self.table[i, j, k]
@@ -1,12 +1,20 @@
+from concurrent.futures import Future
+
 from linux_thermaltake_rgb_plus import drivers, logger
 from linux_thermaltake_rgb_plus import ClassifiedObject
+from linux_thermaltake_rgb_plus.globals import PROTOCOL_LIGHT, PROTOCOL_FAN
+from linux_thermaltake_rgb_plus.io_worker import ControllerIOWorker
 
 
 class ThermaltakeController(ClassifiedObject):
-    def __init__(self, unit=1):
+    def __init__(self, unit=1, transport=None, connect: bool = True):
         self.devices = {}
         self.driver = None
         self.unit = unit
+        # None なら driver が config で選ばれた transport を作る
+        self.transport = transport
+        # False なら device を開かずに offline で始め, reattach() で開く
+        self.connect = connect
         self.ports = 0
         self.init()
 
@@ -15,16 +23,22 @@ class ThermaltakeController(ClassifiedObject):
         if self.ports == 0:
             raise RuntimeError('ports not set')
 
+        # USB の読み書きは全てこのスレッドを通す
+        self.io = ControllerIOWorker(self.driver, name=f'{self.model}-{self.unit}-io',
+                                     online=connect)
+        self.io.start()
+
     @classmethod
-    def factory(cls, unit_type, unit_identifier=None):
-        subclass_dict = {clazz.model: clazz for clazz in cls.inheritors()}
-        try:
-            if unit_identifier is not None:
-                return subclass_dict.get(unit_type.lower())(unit=unit_identifier)
-            else:
-                return subclass_dict.get(unit_type.lower())()
-        except KeyError as e:
-            logger.warn('%s not a valid controller type', e)
+    def factory(cls, unit_type, unit_identifier=None, transport=None, connect: bool = True):
+        clazz = cls.lookup(unit_type)
+        if clazz is None:
+            logger.warn('%s not a valid controller type', unit_type)
+            return None
+
+        if unit_identifier is not None:
+            return clazz(unit=unit_identifier, transport=transport, connect=connect)
+        else:
+            return clazz(transport=transport, connect=connect)
 
     def init(self):
         raise NotImplementedError
@@ -35,15 +49,48 @@ class ThermaltakeController(ClassifiedObject):
 
         return self.devices[port]
 
-    def save_profile(self):
-        self.driver.save_profile()
+    def write(self, data: list, key=None) -> None:
+        """
+        key が同じ書き込みは, 送られる前であれば最新のものだけが送られる.
+        """
+        self.io.write(data, key)
+
+    def set_lighting(self, port: int, mode: int, values=None, future: Future = None) -> None:
+        self.io.submit((PROTOCOL_LIGHT, port), self.driver.set_lighting, port, mode, values,
+                       future=future)
+
+    def set_fan_speed(self, port: int, speed: int, future: Future = None) -> None:
+        self.io.submit((PROTOCOL_FAN, port), self.driver.set_fan_speed, port, speed,
+                       future=future)
+
+    def query(self, data: list, timeout: float = 1.0) -> bytearray:
+        return self.io.query(data).result(timeout)
+
+    def save_profile(self) -> Future:
+        return self.io.call(self.driver.save_profile)
+
+    @property
+    def online(self) -> bool:
+        return self.io.online
+
+    def reattach(self) -> Future:
+        """
+        offline になった controller を開き直す. 成功すると最後の fan duty と lighting frame が
+        送り直される.
+        """
+        return self.io.reattach(self.driver.reconnect)
+
+    def stop(self, timeout: float = None):
+        self.io.stop(timeout)
 
 
 class ThermaltakeG3Controller(ThermaltakeController):
     model = 'g3'
 
     def init(self):
-        self.driver = drivers.ThermaltakeG3ControllerDriver(self.unit)
+        self.driver = drivers.ThermaltakeG3ControllerDriver(self.unit,
+                                                            transport=self.transport,
+                                                            connect=self.connect)
         self.ports = 5
 
 
@@ -51,7 +98,9 @@ class ThermaltakeTTSync5Controller(ThermaltakeController):
     model = 'ttsync5'
 
     def init(self):
-        self.driver = drivers.ThermaltakeTTSync5ControllerDriver(self.unit)
+        self.driver = drivers.ThermaltakeTTSync5ControllerDriver(self.unit,
+                                                                 transport=self.transport,
+                                                                 connect=self.connect)
         self.ports = 5
 
 
@@ -59,7 +108,9 @@ class ThermaltakeRiingTrioController(ThermaltakeController):
     model = 'riingtrio'
 
     def init(self):
-        self.driver = drivers.ThermaltakeRiingTrioControllerDriver(self.unit)
+        self.driver = drivers.ThermaltakeRiingTrioControllerDriver(self.unit,
+                                                                   transport=self.transport,
+                                                                   connect=self.connect)
         self.ports = 5
 
 
@@ -0,0 +1,134 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from linux_thermaltake_rgb_plus import devices, logger
+from linux_thermaltake_rgb_plus.daemon.daemon import ThermaltakeDaemon
+from linux_thermaltake_rgb_plus.devices import FanSpeed
+from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS
+
+
+class AsyncThermaltakeDaemon(ThermaltakeDaemon):
+    """
+    asyncio のアプリケーションに組み込むための daemon.
+    manager は scheduler ではなく event loop 上の task として動く. USB の読み書きは各 controller の
+    I/O スレッドで行うので, 遅い controller があっても event loop や他の controller は止まらない.
+
+        daemon = await AsyncThermaltakeDaemon.create()
+        await daemon.start()
+        await daemon.set_lighting('1:1', [0, 255, 0] * 12)
+        await daemon.stop()
+    """
+
+    def __init__(self, max_workers: int = 4):
+        super().__init__()
+        # センサの読み出しなど, blocking な model の処理を実行する executor
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='async-daemon')
+        self._tasks = []
+
+    @classmethod
+    async def create(cls, max_workers: int = 4):
+        """
+        controller の初期化は blocking なので executor 上で daemon を作る.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: cls(max_workers))
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.profiler is not None:
+            self.profiler.start()
+
+        self._tasks.append(loop.create_task(self._poll_fan_telemetry()))
+        self._tasks.append(loop.create_task(self._poll_hotplug()))
+        self._tasks.append(loop.create_task(self._refresh_frames()))
+
+        logger.debug('starting lighting manager')
+        for lighting_manager in self.lighting_managers.values():
+            self._tasks.append(loop.create_task(lighting_manager.run_async(self._executor)))
+
+        logger.debug('startig fan manager')
+        for fan_manager in self.fan_managers.values():
+            self._tasks.append(loop.create_task(fan_manager.run_async(self._executor)))
+
+    async def stop(self):
+        logger.debug('recieved exit command')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        logger.debug('saving controller profiles')
+        await asyncio.gather(*(asyncio.wrap_future(controller.save_profile())
+                               for controller in self.controllers.values()),
+                             return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        for controller in self.controllers.values():
+            await loop.run_in_executor(self._executor, controller.stop, self.startup_timeout)
+        self._executor.shutdown(wait=False)
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+            self.profiler.dump()
+
+    async def _poll_fan_telemetry(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            self.fan_telemetry.poll()
+
+            deadline += self.fan_telemetry.interval
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    async def _refresh_frames(self):
+        rgb_devices = [dev for dev in self.attached_devices.values()
+                       if isinstance(dev, devices.ThermaltakeRGBDevice) and dev.refresh_interval]
+        if not rgb_devices:
+            return
+        interval = min(dev.refresh_interval for dev in rgb_devices) / 4
+        while True:
+            await asyncio.sleep(interval)
+            for dev in rgb_devices:
+                dev.refresh()
+
+    async def _poll_hotplug(self):
+        while True:
+            # 開き直しは I/O スレッドで行われるので, event loop は待たない
+            self.hotplug.poll()
+            await asyncio.sleep(self.hotplug.interval)
+
+    def _get_device(self, unit_port: str):
+        try:
+            return self.attached_devices[unit_port]
+        except KeyError:
+            raise KeyError(f'device {unit_port} is not registered.')
+
+    async def set_lighting(self, unit_port: str, values: list = None,
+                           mode=TT_RGB_PLUS.RGB_MODE.PER_LED, speed=0x00) -> None:
+        """
+        unit_port ('unit:port') の device の点灯を変え, 書き込みが終わるまで待つ.
+        """
+        future = Future()
+        self._get_device(unit_port).set_lighting(values=values, mode=mode, speed=speed,
+                                                 future=future)
+        await asyncio.wrap_future(future)
+
+    async def set_fan_speed(self, unit_port: str, speed: int) -> None:
+        future = Future()
+        self._get_device(unit_port).set_fan_speed(speed, future=future)
+        await asyncio.wrap_future(future)
+
+    async def get_fan_speed(self, unit_port: str, fresh: bool = False) -> FanSpeed:
+        """
+        telemetry の snapshot から回転数を返す. fresh が True か, まだ読んでいなければ USB から読む.
+        """
+        fan_speed = self.fan_telemetry.get_fan_speed(unit_port)
+        if fan_speed is None or fresh:
+            fan_speed = await asyncio.wrap_future(self._get_device(unit_port).request_fan_speed())
+        return fan_speed
@@ -1,8 +1,9 @@
 import os
 
-import yaml
-
 from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.util import lazy_import
+
+yaml = lazy_import('yaml')
 
 
 class Config:
@@ -12,8 +13,16 @@ class Config:
 
     def __init__(self):
         self.controllers = None
+        self.transport = None
         self.fan_manager = None
         self.lighting_manager = None
+        self.sensors = None
+        self.lighting = None
+        self.telemetry = None
+        self.hotplug = None
+        self.metrics = None
+        self.control = None
+        self.watch_config = True
 
         # if we have config in /etc, use it, otherwise try and use repository config file
         if os.path.isdir(self.abs_config_dir):
@@ -29,6 +38,10 @@ class Config:
         config = self.load_config()
         self.parse_config(config)
 
+    @property
+    def path(self) -> str:
+        return os.path.join(self.config_dir, self.config_file_name)
+
     def load_config(self):
         with open('{}/{}'.format(self.config_dir, self.config_file_name)) as cfg:
             cfg_str = cfg.readlines()
@@ -41,7 +54,8 @@ class Config:
 
         cfg = ''.join(cfg_lines)
         logger.debug('raw config file\n** start **\n\n%s\n** end **\n', cfg)
-        return yaml.load(cfg)
+        # libyaml があれば C 実装の loader を使う
+        return yaml.load(cfg, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
     def parse_config(self, config):
         self.controllers = config.get('controllers')
@@ -53,3 +67,26 @@ class Config:
         self.lighting_manager = config.get('lighting_manager')
         logger.debug(config.get('lighting_manager'))
 
+        self.transport = config.get('transport') or {}
+        logger.debug(config.get('transport'))
+
+        self.sensors = config.get('sensors') or {}
+        logger.debug(config.get('sensors'))
+
+        self.lighting = config.get('lighting') or {}
+        logger.debug(config.get('lighting'))
+
+        self.telemetry = config.get('telemetry') or {}
+        logger.debug(config.get('telemetry'))
+
+        self.hotplug = config.get('hotplug') or {}
+        logger.debug(config.get('hotplug'))
+
+        self.metrics = config.get('metrics') or {}
+        logger.debug(config.get('metrics'))
+
+        self.control = config.get('control') or {}
+        logger.debug(config.get('control'))
+
+        self.watch_config = bool(config.get('watch_config', True))
+
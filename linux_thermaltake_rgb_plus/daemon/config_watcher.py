@@ -0,0 +1,135 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from threading import Event, Thread
+
+from linux_thermaltake_rgb_plus import logger
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+_EVENT = struct.Struct('iIII')
+
+
+class _Inotify:
+    """
+    libc の inotify を ctypes で呼ぶ. 使えない環境では OSError を投げる.
+    """
+
+    def __init__(self, directory: str, mask: int):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch {directory} failed')
+
+    def read_names(self, timeout: float, wakeup_fd: int = None) -> list:
+        """
+        timeout 秒まで event を待ち, 変更されたファイル名のリストを返す.
+        wakeup_fd が読めるようになったら, event を待たずに空のリストを返す.
+        """
+        fds = [self.fd] if wakeup_fd is None else [self.fd, wakeup_fd]
+        readable, _, _ = select.select(fds, [], [], timeout)
+        if self.fd not in readable:
+            return []
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, _, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher:
+    """
+    config.yml が書き換えられたら callback を呼ぶ.
+    エディタは別名で保存してから rename することが多いので, ファイルではなくディレクトリを inotify で
+    監視する. inotify が使えなければ interval 秒ごとに mtime を見る.
+    保存が何回かに分かれても 1 回だけ呼ぶよう, 最後の event から debounce 秒待つ.
+    """
+
+    def __init__(self, path: str, callback, interval: float = 1.0, debounce: float = 0.2):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self.debounce = debounce
+        self._stop = Event()
+        # stop() がここに書き込んで select を起こす (self-pipe)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread = Thread(target=self._main_loop, name='config-watcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        os.write(self._wakeup_w, b'\0')
+        if self._thread.is_alive():
+            self._thread.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _main_loop(self):
+        directory, name = os.path.split(self.path)
+        try:
+            inotify = _Inotify(directory, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        except OSError as e:
+            logger.info(f'inotify unavailable ({e}), polling {self.path} every {self.interval}s')
+            self._poll_loop()
+            return
+
+        logger.info(f'watching {self.path} for changes')
+        try:
+            changed = None
+            while not self._stop.is_set():
+                timeout = self.interval if changed is None else self.debounce
+                names = inotify.read_names(timeout, self._wakeup_r)
+                if name in names:
+                    changed = time.monotonic()
+                elif changed is not None and time.monotonic() - changed >= self.debounce:
+                    changed = None
+                    self._notify()
+        finally:
+            inotify.close()
+
+    def _poll_loop(self):
+        last = self._stat()
+        while not self._stop.wait(self.interval):
+            current = self._stat()
+            if current != last:
+                last = current
+                self._notify()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _notify(self):
+        logger.info(f'{self.path} changed')
+        try:
+            self.callback()
+        except Exception:
+            logger.exception('config reload callback failed')
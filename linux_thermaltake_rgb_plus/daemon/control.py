@@ -0,0 +1,98 @@
+import json
+import socketserver
+import time
+from threading import Thread
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.metrics import CONTROL_LATENCY
+from linux_thermaltake_rgb_plus.util import bind_unix_socket, parse_mode, unlink_unix_socket
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """
+    1 行に 1 つの JSON の request を読み, 1 行の JSON で応答する. 1 つの接続で何回でも送れる.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            start = time.perf_counter()
+            command = None
+            try:
+                request = json.loads(line)
+                command = request.pop('cmd')
+                reply = self.server.control.dispatch(command, request)
+                reply['ok'] = True
+            except Exception as e:
+                reply = {'ok': False, 'error': f'{e.__class__.__name__}: {e}'}
+            CONTROL_LATENCY.labels(command if command in ControlServer.COMMANDS else 'invalid') \
+                .observe(time.perf_counter() - start)
+
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _UnixControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer:
+    """
+    daemon を再起動せずに操作するための unix socket.
+
+        fan: {"cmd": "fan", "device": "1:1", "speed": 60}
+            'unit:port' の fan の duty を固定する. "speed": null で manager の制御に戻す.
+        fan_model: {"cmd": "fan_model", "setting": "default", "model": "locked_speed", "speed": 40}
+        lighting_effect: {"cmd": "lighting_effect", "setting": "default", "model": "full", ...}
+            setting の manager の model を入れ替える. 残りの項目は config.yml の manager と同じ.
+        status: {"cmd": "status"}
+            最後に読んだ温度, 各 device の duty と回転数, 各 manager の model.
+
+        echo '{"cmd": "status"}' | socat - UNIX-CONNECT:/run/linux_thermaltake_rgb_plus/control.sock
+
+    request は接続ごとのスレッドで処理し, manager の状態を変える処理だけを scheduler のスレッドに
+    頼んで完了を待つ. tick は止めない.
+    """
+    COMMANDS = ('fan', 'fan_model', 'lighting_effect', 'status')
+
+    def __init__(self, daemon, path: str, mode: int = 0o600, timeout: float = 2.0):
+        self.daemon = daemon
+        self.path = path
+        self.mode = parse_mode(mode)
+        # scheduler のスレッドでの処理を待つ時間 (秒)
+        self.timeout = timeout
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = bind_unix_socket(self.path, self.mode,
+                                        lambda path: _UnixControlServer(path, _ControlHandler))
+        self._server.control = self
+
+        self._thread = Thread(target=self._server.serve_forever, name='control', daemon=True)
+        self._thread.start()
+        logger.info(f'listening for control requests on {self.path}')
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        unlink_unix_socket(self.path)
+        self._server = None
+
+    def dispatch(self, command: str, request: dict) -> dict:
+        if command == 'fan':
+            future = self.daemon.override_fan_speed(str(request['device']), request.get('speed'))
+        elif command == 'fan_model':
+            future = self.daemon.set_fan_model(str(request.pop('setting')), request)
+        elif command == 'lighting_effect':
+            future = self.daemon.set_lighting_effect(str(request.pop('setting')), request)
+        elif command == 'status':
+            return self.daemon.status()
+        else:
+            raise ValueError(f'unknown command {command}')
+
+        future.result(self.timeout)
+        return {}
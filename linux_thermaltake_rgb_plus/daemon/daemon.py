@@ -1,10 +1,19 @@
 import time
-from threading import Thread
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 from linux_thermaltake_rgb_plus.controllers import ThermaltakeController
+from linux_thermaltake_rgb_plus.drivers import ThermaltakeControllerDriver
 from linux_thermaltake_rgb_plus.fan_manager import FanModel, FanManager
 from linux_thermaltake_rgb_plus.daemon.config import Config
+from linux_thermaltake_rgb_plus.daemon.config_watcher import ConfigWatcher
 from linux_thermaltake_rgb_plus.lighting_manager import LightingEffect, LightingManager
+from linux_thermaltake_rgb_plus.scheduler import Scheduler
+from linux_thermaltake_rgb_plus.sensors import sensor_service, backend_factory
+from linux_thermaltake_rgb_plus.telemetry import FanTelemetry
+from linux_thermaltake_rgb_plus.hotplug import HotplugMonitor
+from linux_thermaltake_rgb_plus import transport
+from linux_thermaltake_rgb_plus.metrics import registry
+from linux_thermaltake_rgb_plus.profiler import SamplingProfiler
 from linux_thermaltake_rgb_plus import devices, logger
 from linux_thermaltake_rgb_plus.devices import ThermaltakeDevice
 
@@ -16,6 +25,15 @@ class ThermaltakeDaemon:
         logger.debug('loading config')
         self.config = Config()
 
+        # 全ての manager で共有する温度センサ. 定期的には読まず, 一番速く読みたい model の
+        # max_age に合わせて読み直す. interval は max_age を決めていない model の既定値
+        self.sensor_service = sensor_service
+        self.sensor_service.interval = float(self.config.sensors.get('interval', 1))
+        self.sensor_service.set_backend(backend_factory(self.config.sensors))
+
+        # fan tick, effect frame, センサの sampling は全てこの scheduler のスレッドで実行する
+        self.scheduler = Scheduler()
+
         # logger.debug('creating lighting manager')
         # lighting_model = LightingEffect.factory(self.config.lighting_manager)
         # self.lighting_manager = LightingManager(lighting_model, 'default')
@@ -23,18 +41,57 @@ class ThermaltakeDaemon:
         self.attached_devices = {}
         self.controllers = {}
 
+        # controller の driver はこの設定で transport を作る
+        transport.configure(self.config.transport)
+
         logger.debug('configuring controllers')
-        for controller in self.config.controllers:
-            self.controllers[controller['unit']] \
-                = ThermaltakeController.factory(controller['type'], controller['unit'])
+        self.startup_timeout = float(self.config.transport.get('startup_timeout', 10))
+        self.start_controllers(self.startup_timeout)
 
+        for controller in self.config.controllers:
+            if controller['unit'] not in self.controllers:
+                continue
             for id, model in controller['devices'].items():
                 logger.debug(' configuring devices for controller %s: %s',
                              controller['type'], controller['unit'])
                 dev = ThermaltakeDevice.factory(model)
+                if isinstance(dev, devices.ThermaltakeRGBDevice) \
+                        and 'refresh_interval' in self.config.lighting:
+                    dev.refresh_interval = self.config.lighting['refresh_interval']
                 self.controllers[controller['unit']].attach_device(id, dev)
                 self.register_attached_device(controller['unit'], id, dev)
 
+        # fan の回転数は manager とは別の周期でまとめて読む
+        self.fan_telemetry = FanTelemetry(self.controllers,
+                                          float(self.config.telemetry.get('interval', 1)))
+
+        # 抜き差しや reset で offline になった controller を開き直す
+        self.hotplug = HotplugMonitor(self.controllers,
+                                      float(self.config.hotplug.get('interval', 2)))
+
+        # metrics を読みに来る人がいなければ server は立てない
+        self.metrics_server = None
+        if self.config.metrics.get('listen'):
+            # http.server は metrics を有効にしたときにだけ読み込む
+            from linux_thermaltake_rgb_plus.metrics_server import MetricsServer
+            self.metrics_server = MetricsServer(str(self.config.metrics['listen']),
+                                                self.config.metrics.get('mode', 0o600))
+        self._register_metrics()
+
+        # 実行中に fan の duty や effect を変えるための socket. path がなければ立てない
+        self.control_server = None
+        if self.config.control.get('path'):
+            from linux_thermaltake_rgb_plus.daemon.control import ControlServer
+            self.control_server = ControlServer(self, str(self.config.control['path']),
+                                                self.config.control.get('mode', 0o600))
+
+        # LINUX_THERMALTAKE_RGB_PLUS_PROFILE が設定されていれば起動時から stack を sampling する
+        self.profiler = SamplingProfiler.from_environ()
+
+        # config の再読み込みで変わった manager だけを作り直せるよう, 各 manager の元の項目を残す
+        self._manager_plans = {}
+        self.config_watcher = None
+
         # self.prepare_fan_manager()
         self.fan_managers = self.prepare_manager(self.config.fan_manager,
                                                  FanModel,
@@ -43,8 +100,102 @@ class ThermaltakeDaemon:
                                                       LightingEffect,
                                                       LightingManager)
 
-        self._thread = Thread(target=self._main_loop)
-        self._continue = False
+    def start_controllers(self, timeout: float = 10.0):
+        """
+        bus を 1 回だけ走査し, 全ての controller の reset, claim, INIT を並列に行う.
+        開くのは各 controller の I/O スレッド (daemon スレッド) なので, reset が返らなくても
+        daemon の終了は妨げない. timeout 秒以内に立ち上がらなかった controller と見つからなかった
+        controller も offline のまま登録し, HotplugMonitor が開き直し続ける.
+        """
+        start = time.perf_counter()
+        usb_devices = transport.enumerate_devices(ThermaltakeControllerDriver.VENDOR_ID)
+        logger.info(f'found {len(usb_devices)} usb devices in '
+                    f'{(time.perf_counter() - start) * 1000:.1f} ms')
+
+        def on_ready(unit_type, unit, began, future):
+            if future.exception() is None:
+                logger.info(f'controller {unit_type} {unit} ready in '
+                            f'{(time.perf_counter() - began) * 1000:.1f} ms')
+
+        futures = {}
+        for controller in self.config.controllers:
+            unit_type, unit = controller['type'], controller['unit']
+            began = time.perf_counter()
+            # device を開かずに作るので, ここでは USB の読み書きはしない
+            instance = ThermaltakeController.factory(
+                unit_type, unit, transport=transport.transport_factory(devices=usb_devices),
+                connect=False)
+            if instance is None:
+                logger.error(f'unknown controller type {unit_type}, skipping controller {unit}')
+                continue
+            self.controllers[unit] = instance
+            futures[unit] = instance.reattach()
+            futures[unit].add_done_callback(
+                lambda future, unit_type=unit_type, unit=unit, began=began:
+                    on_ready(unit_type, unit, began, future))
+
+        deadline = time.monotonic() + timeout
+        started = 0
+        for unit, future in futures.items():
+            try:
+                future.result(max(0.0, deadline - time.monotonic()))
+                started += 1
+            except FutureTimeoutError:
+                logger.error(f'controller {unit} did not start within {timeout}s, '
+                             f'keeping it offline until it responds')
+            except Exception as e:
+                logger.error(f'failed to start controller {unit}, keeping it offline: {e}')
+
+        logger.info(f'{started}/{len(futures)} controllers started in '
+                    f'{(time.perf_counter() - start) * 1000:.1f} ms')
+
+    def _register_metrics(self):
+        """
+        device が既に数えている値は scrape のときに読むだけにする.
+        """
+        def rgb_devices():
+            return ((unit_port, dev) for unit_port, dev in self.attached_devices.items()
+                    if isinstance(dev, devices.ThermaltakeRGBDevice))
+
+        registry.callback('thermaltake_frames_sent_total', 'lighting frames sent to the device',
+                          'counter',
+                          lambda: (((unit_port,), dev.frames_sent)
+                                   for unit_port, dev in rgb_devices()),
+                          ('device',))
+        registry.callback('thermaltake_frames_suppressed_total',
+                          'lighting frames not sent because they did not change', 'counter',
+                          lambda: (((unit_port,), dev.frames_suppressed)
+                                   for unit_port, dev in rgb_devices()),
+                          ('device',))
+        registry.callback('thermaltake_frames_refreshed_total',
+                          'unchanged lighting frames sent again after refresh_interval',
+                          'counter',
+                          lambda: (((unit_port,), dev.frames_refreshed)
+                                   for unit_port, dev in rgb_devices()),
+                          ('device',))
+
+        def write_policy_counter(name, help, attribute):
+            # 再読み込みで manager が作り直されても, scrape のときの manager から読む
+            registry.callback(name, help, 'counter',
+                              lambda: (((setting_name,), getattr(manager.write_policy, attribute))
+                                       for setting_name, manager
+                                       in getattr(self, 'fan_managers', {}).items()),
+                              ('manager',))
+
+        write_policy_counter('thermaltake_fan_writes_total', 'fan duties written by the manager',
+                             'writes')
+        write_policy_counter('thermaltake_fan_writes_saved_total',
+                             'fan duty writes skipped by the write policy', 'saved')
+        write_policy_counter('thermaltake_fan_emergency_writes_total',
+                             'fan duties written immediately because of emergency_temp',
+                             'emergency_writes')
+
+        registry.callback('thermaltake_controller_online',
+                          '1 if the controller is attached, 0 while waiting for it to come back',
+                          'gauge',
+                          lambda: (((unit,), int(controller.online))
+                                   for unit, controller in self.controllers.items()),
+                          ('unit',))
 
     def _register_devices_to_manager(self, manager, unit_ports):
         for unit_port in unit_ports:
@@ -67,43 +218,53 @@ class ThermaltakeDaemon:
 
         return unit_ports
 
-    def prepare_manager(self, config_managers, Model, Manager):
-        managers = {}
+    def _plan_managers(self, config_managers) -> dict:
+        """
+        config の manager の項目ごとに (項目, 'unit:port' のリスト) を返す.
+        default manager は他のどの manager にも登録されていない device を受け持つ.
+        """
+        plan = {}
         rested_devices = list(self.attached_devices.keys())
 
-        # mageger を設定する
-        i = 0
-        default_num = None
+        default_manager = None
         for conf_mngr in config_managers:
             setting_name = conf_mngr['setting']
             if setting_name.lower() == 'default':
                 # default が config.yaml 中に複数ある場合, 最後に 'default'.lower() だったものを
                 # default として設定する.
-                default_num = i
-                i += 1
+                default_manager = conf_mngr
                 continue
-            model = Model.factory(conf_mngr)
-            managers[setting_name] = Manager(model, setting_name)
 
-            unit_ports = self._convert_devicesDict_to_unit_ports(conf_mngr['devices'])
-            self._register_devices_to_manager(manager=managers[setting_name],
-                                              unit_ports=unit_ports)
-            for unit_port in unit_ports:
+            unit_ports = []
+            for unit_port in self._convert_devicesDict_to_unit_ports(conf_mngr['devices']):
+                if unit_port not in self.attached_devices:
+                    # controller が立ち上がらなかった device
+                    logger.warning(f'device {unit_port} of {setting_name} is not attached')
+                    continue
                 rested_devices.remove(unit_port)
-            i += 1
+                unit_ports.append(unit_port)
+            plan[setting_name] = (conf_mngr, unit_ports)
 
-        # default manager を設定する.
-        if default_num is None:
+        if default_manager is None:
             logger.debug('default fan manager is not existed.')
             raise KeyError
 
-        default_manager = config_managers[default_num]
-        model = Model.factory(default_manager)
-        managers['default'] = Manager(model, 'default')
-        self._register_devices_to_manager(manager=managers['default'],
-                                          unit_ports=rested_devices)
+        plan['default'] = (default_manager, rested_devices)
+        return plan
 
-        return managers
+    def _build_manager(self, Model, Manager, setting_name, conf_mngr, unit_ports):
+        # factory は項目から 'model' を取り除くので, 再読み込みで比べられるよう複製を渡す
+        model = Model.factory(dict(conf_mngr))
+        manager = Manager(model, setting_name, self.scheduler)
+        manager.configure(conf_mngr)
+        self._register_devices_to_manager(manager=manager, unit_ports=unit_ports)
+        return manager
+
+    def prepare_manager(self, config_managers, Model, Manager):
+        plan = self._plan_managers(config_managers)
+        self._manager_plans[Manager] = plan
+        return {setting_name: self._build_manager(Model, Manager, setting_name, *item)
+                for setting_name, item in plan.items()}
 
     def prepare_fan_manager(self):
         logger.debug('prepare fan managers')
@@ -122,7 +283,7 @@ class ThermaltakeDaemon:
                 continue
 
             fan_model = FanModel.factory(fan_manager)
-            self.fan_managers[setting_name] = FanManager(fan_model, setting_name)
+            self.fan_managers[setting_name] = FanManager(fan_model, setting_name, self.scheduler)
 
             unit_ports = self._convert_devicesDict_to_unit_ports(fan_manager['devices'])
             self._register_devices_to_manager(manager=self.fan_managers[setting_name],
@@ -139,18 +300,210 @@ class ThermaltakeDaemon:
 
         default_fan_manager = self.config.fan_manager[default_num]
         fan_model = FanModel.factory(default_fan_manager)
-        self.fan_managers['default'] = FanManager(fan_model, 'default')
+        self.fan_managers['default'] = FanManager(fan_model, 'default', self.scheduler)
         self._register_devices_to_manager(manager=self.fan_managers['default'],
                                           unit_ports=rested_devices)
 
+    def reload_config(self):
+        """
+        config.yml を読み直し, fan_managers と lighting_manager のうち変わった項目の manager だけを
+        作り直す. controller (USB) と変わっていない manager はそのまま動かし続ける.
+        """
+        try:
+            config = Config()
+            fan_plan = self._plan_managers(config.fan_manager)
+            lighting_plan = self._plan_managers(config.lighting_manager)
+        except Exception as e:
+            logger.error(f'failed to reload config, keeping the current one: {e}')
+            return
+
+        if config.controllers != self.config.controllers:
+            logger.warning('controllers changed in config, restart the daemon to apply them')
+
+        self.fan_managers = self._reload_managers(self.fan_managers, fan_plan,
+                                                  FanModel, FanManager)
+        self.config.fan_manager = config.fan_manager
+        self.lighting_managers = self._reload_managers(self.lighting_managers, lighting_plan,
+                                                       LightingEffect, LightingManager)
+        self.config.lighting_manager = config.lighting_manager
+
+    def _reload_managers(self, managers, plan, Model, Manager) -> dict:
+        old_plan = self._manager_plans[Manager]
+        changed = [setting_name for setting_name, item in plan.items()
+                   if old_plan.get(setting_name) != item]
+        removed = [setting_name for setting_name in old_plan
+                   if setting_name not in plan or setting_name in changed]
+        if not changed and not removed:
+            return managers
+
+        # 新しい manager を全て作れたときだけ入れ替える
+        try:
+            built = {setting_name: self._build_manager(Model, Manager, setting_name,
+                                                       *plan[setting_name])
+                     for setting_name in changed}
+        except Exception as e:
+            logger.error(f'failed to rebuild {Manager.__name__}, keeping the current ones: {e}')
+            return managers
+
+        stopped = {}
+        for setting_name in removed:
+            logger.info(f'stopping {Manager.__name__} {setting_name}')
+            stopped[setting_name] = managers[setting_name]
+            stopped[setting_name].stop()
+
+        # stream の socket のように, 前の manager を止めるまで確かめられないものは start で失敗する.
+        # そのときは始めた manager を止めて前の manager を動かし直す
+        started = []
+        try:
+            for setting_name, manager in built.items():
+                logger.info(f'starting {Manager.__name__} {setting_name}')
+                started.append(manager)
+                manager.start()
+        except Exception as e:
+            logger.error(f'failed to start {Manager.__name__} {setting_name}, '
+                         f'keeping the current ones: {e}')
+            for manager in started:
+                manager.stop()
+            for setting_name, manager in stopped.items():
+                logger.info(f'restarting {Manager.__name__} {setting_name}')
+                manager.start()
+            return managers
+
+        managers = {setting_name: manager for setting_name, manager in managers.items()
+                    if setting_name not in stopped}
+        managers.update(built)
+        self._manager_plans[Manager] = plan
+        return managers
+
+    def _schedule_reload(self):
+        # manager の入れ替えは tick と重ならないよう scheduler のスレッドで行う
+        self.scheduler.schedule(self.reload_config, name='config reload')
+
     def register_attached_device(self, unit, port, dev=None):
         self.attached_devices[f'{unit}:{port}'] = dev
 
-    def run(self):
-        self._continue = True
+    def get_fan_speed(self, unit_port: str):
+        """
+        telemetry が最後に読んだ 'unit:port' の FanSpeed を返す. USB の往復はしない.
+        """
+        return self.fan_telemetry.get_fan_speed(unit_port)
+
+    def run_in_scheduler(self, func, *args) -> Future:
+        """
+        func(*args) を scheduler のスレッドで実行する. manager の tick や effect の frame とは重ならない.
+        """
+        future = Future()
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except Exception as e:
+                    future.set_exception(e)
+
+        self.scheduler.schedule(run, name=getattr(func, '__name__', 'call'))
+        return future
+
+    def override_fan_speed(self, unit_port: str, speed: int = None) -> Future:
+        """
+        'unit:port' の fan の duty を manager に関係なく speed に固定する. None で manager に戻す.
+        """
+        dev = self.attached_devices.get(unit_port)
+        if not isinstance(dev, devices.ThermaltakeFanDevice):
+            raise KeyError(f'{unit_port} is not an attached fan')
+        if speed is not None and not 0 <= int(speed) <= 100:
+            raise ValueError(f'speed {speed} is not between 0 and 100')
+        return self.run_in_scheduler(dev.override_fan_speed, speed)
+
+    def set_fan_model(self, setting_name: str, config: dict) -> Future:
+        return self._swap_model(self.fan_managers, FanModel, setting_name, config)
+
+    def set_lighting_effect(self, setting_name: str, config: dict) -> Future:
+        return self._swap_model(self.lighting_managers, LightingEffect, setting_name, config)
+
+    def _swap_model(self, managers, Model, setting_name, config) -> Future:
+        # config は config.yml の manager の項目と同じ形 ({'model': ..., 設定...}).
+        # model は呼び出したスレッドで作り, 入れ替えだけを scheduler のスレッドで行う
+        try:
+            manager = managers[setting_name]
+        except KeyError:
+            raise KeyError(f'manager {setting_name} not found')
+        model = Model.factory(dict(config))
+        return self.run_in_scheduler(manager.set_model, model)
+
+    def status(self) -> dict:
+        """
+        最後に読んだ温度, 各 device の duty と回転数, 各 manager の model を返す.
+        USB もセンサも読まず, snapshot を集めるだけ.
+        """
+        fan_managers = {}
+        for setting_name, (_, unit_ports) in self._manager_plans.get(FanManager, {}).items():
+            for unit_port in unit_ports:
+                fan_managers[unit_port] = setting_name
+
+        device_status = {}
+        for unit_port, dev in self.attached_devices.items():
+            item = {'model': dev.model, 'online': dev.controller.online}
+            if isinstance(dev, devices.ThermaltakeFanDevice):
+                fan_speed = self.fan_telemetry.get_fan_speed(unit_port)
+                setting_name = fan_managers.get(unit_port)
+                manager = self.fan_managers.get(setting_name)
+                item.update(
+                    manager=setting_name,
+                    temperature=getattr(manager and manager.current_model, 'last_temp', None),
+                    duty=dev.duty,
+                    override=dev.speed_override,
+                    rpm=fan_speed.rpm if fan_speed else None)
+            device_status[unit_port] = item
+
+        return {
+            'temperatures': {sensor_name: reading.current for sensor_name, reading
+                             in self.sensor_service.snapshot().items()},
+            'devices': device_status,
+            'fan_managers': {setting_name: {
+                'model': getattr(manager.current_model, 'model', None),
+                'interval': manager.interval,
+                'writes': manager.write_policy.writes,
+                'saved': manager.write_policy.saved,
+                'emergency_writes': manager.write_policy.emergency_writes,
+            } for setting_name, manager in self.fan_managers.items()},
+            'lighting_managers': {setting_name: getattr(manager.current_model, 'model', None)
+                                  for setting_name, manager in self.lighting_managers.items()},
+        }
+
+    def _schedule_frame_refresh(self):
+        """
+        set_lighting を 1 回しか呼ばない effect でも, controller が状態を失ったときに戻るよう
+        RGB device ごとに最後の frame を refresh_interval 秒ごとに送り直す.
+        """
+        for unit_port, dev in self.attached_devices.items():
+            if isinstance(dev, devices.ThermaltakeRGBDevice) and dev.refresh_interval:
+                # 最後に送った時刻との位相のずれで送り直しが遅れすぎないよう, 細かめに確かめる
+                self.scheduler.schedule(dev.refresh, dev.refresh_interval / 4,
+                                        delay=dev.refresh_interval / 4,
+                                        name=f'{unit_port} frame refresh')
 
-        logger.debug('starting main thread')
-        self._thread.start()
+    def run(self):
+        try:
+            self._start()
+        except Exception as e:
+            # scheduler のスレッドは daemon スレッドではないので, 止めずに投げるとプロセスが終わらない
+            logger.error(f'failed to start the daemon: {e}')
+            self.stop()
+            raise
+
+    def _start(self):
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.profiler is not None:
+            self.profiler.start()
+
+        logger.debug('starting scheduler')
+        # センサは定期的には読まない. model が get_temp したときに snapshot が古ければ読み直す
+        self.fan_telemetry.start(self.scheduler)
+        self.hotplug.start(self.scheduler)
+        self._schedule_frame_refresh()
+        self.scheduler.start()
 
         logger.debug('starting lighting manager')
         for lighting_manager in self.lighting_managers.values():
@@ -160,9 +513,19 @@ class ThermaltakeDaemon:
         for fan_manager in self.fan_managers.values():
             fan_manager.start()
 
+        if self.config.watch_config:
+            self.config_watcher = ConfigWatcher(self.config.path, self._schedule_reload)
+            self.config_watcher.start()
+
+        if self.control_server is not None:
+            self.control_server.start()
+
     def stop(self):
         logger.debug('recieved exit command')
-        self._continue = False
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+        if self.control_server is not None:
+            self.control_server.stop()
 
         logger.debug('stopping lighting manager')
         for lighting_manager in self.lighting_managers.values():
@@ -172,14 +535,21 @@ class ThermaltakeDaemon:
         for fan_manager in self.fan_managers.values():
             fan_manager.stop()
 
-        logger.debug('stopping main thread')
-        self._thread.join()
+        self.fan_telemetry.stop()
+        self.hotplug.stop()
+
+        logger.debug('stopping scheduler')
+        self.scheduler.stop()
 
         logger.debug('saving controller profiles')
         for controller in self.controllers.values():
             controller.save_profile()
+            # reset が返らない controller の I/O スレッドは待たない
+            controller.stop(self.startup_timeout)
 
-    def _main_loop(self):
-        while self._continue:
-            time.sleep(1)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+            self.profiler.dump()
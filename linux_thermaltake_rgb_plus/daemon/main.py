@@ -3,6 +3,7 @@ import sys
 
 from linux_thermaltake_rgb_plus import DEBUG
 from linux_thermaltake_rgb_plus.daemon.daemon import ThermaltakeDaemon
+from linux_thermaltake_rgb_plus.profiler import install_signal_handler
 
 
 def main():
@@ -11,6 +12,8 @@ def main():
                         format='%(message)s')
 
     daemon = ThermaltakeDaemon()
+    # kill -USR1 で profiler を開始し, もう一度送ると止めて /tmp/linux_thermaltake_rgb_plus に書き出す
+    install_signal_handler(daemon)
     try:
         daemon.run()
     except KeyboardInterrupt:
@@ -1,9 +1,10 @@
+import time
 from collections import namedtuple
+from concurrent.futures import Future
 
 from linux_thermaltake_rgb_plus import logger
 from linux_thermaltake_rgb_plus import ClassifiedObject
-from linux_thermaltake_rgb_plus.globals \
-    import PROTOCOL_SET, PROTOCOL_LIGHT, PROTOCOL_FAN, PROTOCOL_GET
+from linux_thermaltake_rgb_plus.globals import PROTOCOL_FAN, PROTOCOL_GET
 
 FanSpeed = namedtuple('FanSpeed', ['get_speed', 'rpm'])
 
@@ -20,57 +21,140 @@ class ThermaltakeDevice(ClassifiedObject):
 
     @classmethod
     def factory(cls, model):
-        # NOTE: これがなにをしているのか?
-        subclass_dict = {clazz.model.lower(): clazz for clazz in cls.inheritors()
-                         if clazz.model is not None}
+        clazz = cls.lookup(model)
+        if clazz is None:
+            logger.warn(f'model {model} not found')
+            raise KeyError(model)
 
-        try:
-            dev = subclass_dict[model.lower()]()
-            logger.debug('created {} device'.format(dev.__class__.__name__))
-            return dev
-        except KeyError:
-            logger.warn(f'model {model} not found. controller: {controller} port: {port}')
-            raise KeyError
+        dev = clazz()
+        logger.debug('created {} device'.format(dev.__class__.__name__))
+        return dev
 
 
 class ThermaltakeRGBDevice(ThermaltakeDevice):
     num_leds = 0
     index_per_led = 0
 
-    def set_lighting(self, values: list = None, mode=0x18, speed=0x00) -> None:
+    # 同じ frame でもこの秒数が経てば送り直す (controller が状態を失った場合のため). None なら送り直さない.
+    refresh_interval = 30.0
+
+    def __init__(self):
+        super().__init__()
+        self._last_frame = None
+        self._last_request = None
+        self._last_sent = 0.0
+        self.frames_sent = 0
+        self.frames_suppressed = 0
+        self.frames_refreshed = 0
+
+    def set_lighting(self, values: list = None, mode=0x18, speed=0x00,
+                     future: Future = None) -> None:
         """
         パフォーマンスのため, 渡されたデータは正しいものとして処理する.
+        直前に送ったものと同じ frame は refresh_interval が経つまで送らない.
         :param values: [g,r,b,...]
         :param mode: lighting mode(hex)
         :param speed: light update speed(hex)
+        :param future: 書き込みが終わった (または送る必要がなかった) ときに完了する
         """
-        # write bytes
-        data = [PROTOCOL_SET, PROTOCOL_LIGHT, self.port, mode + speed]
-        if values:
-            data.extend(values)
-        logger.debug('{} set lighting: raw hex: {}'.format(self.__class__.__name__, data))
+        if isinstance(values, list):
+            frame = (mode, speed, hash(tuple(values)))
+        else:
+            frame = (mode, speed, hash(values))
+
+        now = time.monotonic()
+        if frame == self._last_frame and (self.refresh_interval is None
+                                          or now - self._last_sent < self.refresh_interval):
+            self.frames_suppressed += 1
+            if future is not None:
+                future.set_result(None)
+            return
+        self._last_frame = frame
+        # refresh() で送り直せるよう, list は呼び出し元が書き換えても変わらないよう複製しておく
+        self._last_request = (list(values) if isinstance(values, list) else values, mode + speed)
+        self._last_sent = now
+        self.frames_sent += 1
+
+        logger.debug('%s set lighting: mode %s, values %s',
+                      self.__class__.__name__, mode + speed, values)
 
         # Set RGB Command
-        self.controller.driver.write_out(data)
+        self.controller.set_lighting(self.port, mode + speed, values, future)
+
+    def invalidate_frame(self) -> None:
+        """
+        次の set_lighting を必ず送るようにする.
+        """
+        self._last_frame = None
+
+    def refresh(self) -> None:
+        """
+        最後に送った frame から refresh_interval 秒経っていれば同じ frame を送り直す.
+        full や wave のように set_lighting を最初の 1 回しか呼ばない effect のため, daemon が
+        定期的に呼ぶ.
+        """
+        if self._last_request is None or self.refresh_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_sent < self.refresh_interval:
+            return
+
+        self._last_sent = now
+        self.frames_refreshed += 1
+        values, mode = self._last_request
+        self.controller.set_lighting(self.port, mode, values)
 
 
 class ThermaltakeFanDevice(ThermaltakeDevice):
-    def set_fan_speed(self, speed: int):
-        # write bytes
-        data = [PROTOCOL_SET, PROTOCOL_FAN, self.port, 0x01, int(speed)]
+    # manager が最後に要求した duty
+    requested_speed = None
+    # None でなければ manager が要求した duty の代わりにこれを送る
+    speed_override = None
+
+    @property
+    def duty(self):
+        return self.requested_speed if self.speed_override is None else self.speed_override
+
+    def set_fan_speed(self, speed: int, future: Future = None):
+        self.requested_speed = int(speed)
+        if self.speed_override is not None:
+            speed = self.speed_override
 
         # Set Speed Command
-        self.controller.driver.write_out(data)
+        self.controller.set_fan_speed(self.port, int(speed), future)
+
+    def override_fan_speed(self, speed: int = None, future: Future = None):
+        """
+        manager に関係なく duty を speed に固定する. None なら manager が最後に要求した duty に戻す.
+        manager の tick と同じスレッドから呼ぶこと.
+        """
+        self.speed_override = None if speed is None else int(speed)
+        if self.duty is not None:
+            self.controller.set_fan_speed(self.port, self.duty, future)
+        elif future is not None:
+            future.set_result(None)
+
+    def get_fan_speed(self, timeout: float = 1.0):
+        return self.request_fan_speed().result(timeout)
 
-    def get_fan_speed(self):
+    def request_fan_speed(self) -> Future:
+        """
+        controller の I/O スレッドで回転数を読む. 結果 (FanSpeed) は返り値の Future で受け取る.
+        """
+        return self.controller.io.call(self.read_fan_speed)
+
+    def read_fan_speed(self):
+        """
+        controller の I/O スレッドから呼ぶこと.
+        """
         # write bytes
         data = [PROTOCOL_GET, PROTOCOL_FAN, self.port]
 
         # Get Data Command
-        self.controller.driver.write_out(data)
+        reply = self.controller.driver.query(data)
 
         # Read Bytes
-        id, unknown, speed, rpm_l, rpm_h = self.controller.driver.read_in()[2:7]
+        id, unknown, speed, rpm_l, rpm_h = reply[2:7]
 
         # RPM is calculated as '(rpm_h << 8) + rpm_l'
         return FanSpeed(speed, (rpm_h << 8) + rpm_l)
@@ -1,81 +1,117 @@
-import usb
+import time
+from array import array
 
 from linux_thermaltake_rgb_plus import logger
-from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS
+from linux_thermaltake_rgb_plus import metrics
+from linux_thermaltake_rgb_plus.transport import transport_factory, is_disconnect
+from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS, PACKET_LENGTH
+from linux_thermaltake_rgb_plus.globals \
+    import PROTOCOL_SET, PROTOCOL_LIGHT, PROTOCOL_FAN
+
+
+class PacketEncoder:
+    """
+    port とコマンドの種類ごとに 64 byte のバッファを使い回して packet を組み立てる.
+    header は最初に 1 回だけ書き, payload は memoryview で上書きする.
+    pyusb は array('B') をそのまま libusb に渡すので, バッファは bytearray ではなく array('B') にする.
+    I/O スレッドからだけ呼ぶこと.
+    """
+
+    def __init__(self, length: int = PACKET_LENGTH):
+        self.length = length
+        self._zeros = memoryview(bytes(length))
+        self._buffers = {}
+
+    def _buffer(self, key, header=()) -> list:
+        buf = self._buffers.get(key)
+        if buf is None:
+            data = array('B', bytes(self.length))
+            view = memoryview(data)
+            view[:len(header)] = bytes(header)
+            # [バッファ, memoryview, 書き込み済みの長さ]
+            buf = self._buffers[key] = [data, view, len(header)]
+        return buf
+
+    def _fill(self, buf, offset: int, payload) -> memoryview:
+        view = buf[1]
+        end = offset + len(payload)
+        if end > self.length:
+            raise OverflowError(f'packet length {end} exceeds {self.length}')
+
+        if payload:
+            if not isinstance(payload, (bytes, bytearray, memoryview, array)):
+                payload = bytes(payload)
+            view[offset:end] = payload
+
+        # 前回の packet の方が長ければ, 残った部分を 0 に戻す
+        if buf[2] > end:
+            view[end:buf[2]] = self._zeros[:buf[2] - end]
+        buf[2] = end
+        return buf[0]
+
+    def encode(self, data) -> array:
+        """
+        任意のコマンドを 0x00 で埋めた packet にする.
+        """
+        return self._fill(self._buffer(None), 0, data)
+
+    def encode_lighting(self, port: int, mode: int, values=None) -> array:
+        buf = self._buffer((PROTOCOL_LIGHT, port), (PROTOCOL_SET, PROTOCOL_LIGHT, port, mode))
+        buf[1][3] = mode
+        return self._fill(buf, 4, values or ())
+
+    def encode_fan_speed(self, port: int, speed: int) -> array:
+        buf = self._buffer((PROTOCOL_FAN, port), (PROTOCOL_SET, PROTOCOL_FAN, port, 0x01, 0))
+        buf[1][4] = speed
+        return buf[0]
 
 
 class ThermaltakeControllerDriver:
     """
     Thermaltake controller 抽象クラス
     抽象クラスのため, product_id は None としておく.
+    transport を渡さなければ config (または環境変数) で選ばれた transport を使う.
+    connect を False にすると device を開かずに作る.
     """
     VENDOR_ID = 0x264a
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, transport=None, connect: bool = True, **kwargs):
         self.vendor_id = self.VENDOR_ID
         self.product_id = None
+        self.encoder = PacketEncoder()
+        self.transport = transport or transport_factory()
+        self.unit = None
         self.init(*args, **kwargs)
 
-        self._initialize_device()
+        # 記録は I/O スレッドからだけなので child をここで 1 回だけ取り出しておく
+        self._writes = metrics.USB_WRITES.labels(self.unit)
+        self._reads = metrics.USB_READS.labels(self.unit)
+        self._write_latency = metrics.USB_LATENCY.labels(self.unit, 'out')
+        self._read_latency = metrics.USB_LATENCY.labels(self.unit, 'in')
+
+        # connect が False なら device は後で reconnect() で開く
+        if connect:
+            self._initialize_device()
 
     def init(self, *args, **kwargs):
         raise NotImplementedError
 
     def _initialize_device(self):
-        self.device = usb.core.find(idVendor=self.vendor_id,
-                                    idProduct=self.product_id)
-        # 最後のデバイスの利用の仕方が汚いと安全性が損なわれるので, 一度resetする.
-        try:
-            self.device.reset()
-        except usb.core.USBerror as e:
-            logger.error('usb device access denied (insufficient permissions)')
-            raise e
-
-        if self.device is None:
-            raise ValueError('Device not found')
-
-        # linux kernel はUSBデバイスがポートに挿入されたとき, 自動的にデバイスに対してデバイスドライ
-        # バを関連付けてくれる. しかし, そのせいで他のデバイスドライバがUSBデバイスに対してアクセス
-        # できなくなってしまう. そこで, 一度 detach する.
-        try:
-            self.device.detach_kernel_driver(0)
-        except Exception:
-            logger.warning('kernel driver already detached')
-
-        # 使うためのconfigurationをアクティブにする. (引数なしはfirst configurationを選ぶことになる)
-        self.device.set_configuration()
-
-        # usbデバイスのinterfaceの所有権を取得したいことをlinux kernelに宣言するために, interface を
-        # 要求する.
-        try:
-            usb.util.claim_interface(self.device, 0)
-        except usb.core.USBerror as e:
-            logger.error('{} while claiming interface for device'.format(e))
-            raise e
-
-        # たぶん, configurationディスクリプタの取得要求. configurationディスクリプタの取得要求に対し
-        # て, interfaceディスクリプタとendpointディスクリプタも合わせて戻す使用になっていることが一
-        # 般的なので, 次の行でinterfaceディスクリプタが戻されていると思われる.
-        self.cfg = self.device.get_active_configuration()
-        self.interface = self.cfg[(0, 0)]
-
-        # 出力方向のエンドポイントを取得.
-        self.endpoint_out = usb.util.find_descriptor(
-                self.interface,
-                custom_match=lambda e:
-                    usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
-        assert self.endpoint_out is not None
-
-        # 入力方向のエンドポイントを取得.
-        self.endpoint_in = usb.util.find_descriptor(
-                self.interface,
-                custom_match=lambda e:
-                    usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN)
-        assert self.endpoint_in is not None
+        self.transport.open(self.vendor_id, self.product_id)
 
         # usbデバイスを初期化, リセットする.
         self.init_controller()
 
+    def reconnect(self):
+        """
+        抜き差しや reset で handle が無効になった device を開き直し, INIT し直す.
+        """
+        try:
+            self.transport.close()
+        except Exception as e:
+            logger.debug(f'closing stale device: {e}')
+        self._initialize_device()
+
     def init_controller(self):
         raise NotImplementedError()
 
@@ -89,29 +125,86 @@ class ThermaltakeControllerDriver:
     def _populate_partial_data_array(self, in_array: list, length=64) -> list:
         """
         要求された長さに到達するまで, 0x00で配列の後ろを埋める
-        ****なんでこんなの必要なんだ？****
+        (controller は常に 64 byte の packet を受け取る)
         """
-        array = list(in_array)
-        array.extend(self._generate_data_array(length=len(in_array)))
+        data_array = list(in_array)
+        data_array.extend(self._generate_data_array(length=length - len(in_array)))
 
-        return array
+        return data_array
+
+    def _write(self, packet) -> None:
+        start = time.perf_counter()
+        try:
+            self.transport.write(packet)
+        except Exception as e:
+            self._count_error(e)
+            raise
+        self._write_latency.observe(time.perf_counter() - start)
+        self._writes.inc()
+
+    def _read(self, length: int):
+        start = time.perf_counter()
+        try:
+            reply = self.transport.read(length)
+        except Exception as e:
+            self._count_error(e)
+            raise
+        self._read_latency.observe(time.perf_counter() - start)
+        self._reads.inc()
+        return reply
+
+    def _count_error(self, e: Exception) -> None:
+        if metrics.is_timeout(e):
+            kind = 'timeout'
+        elif is_disconnect(e):
+            kind = 'disconnect'
+        else:
+            kind = 'error'
+        metrics.USB_ERRORS.labels(self.unit, kind).inc()
 
     def write_out(self, data: list, length: int = 64) -> None:
         try:
-            self.endpoint_out.write(self._populate_partial_data_array(data, length))
+            if length == self.encoder.length:
+                self._write(self.encoder.encode(data))
+            else:
+                self._write(self._populate_partial_data_array(data, length))
         except OverflowError:
             return
 
+    def set_lighting(self, port: int, mode: int, values=None) -> None:
+        try:
+            self._write(self.encoder.encode_lighting(port, mode, values))
+        except OverflowError:
+            return
+
+    def set_fan_speed(self, port: int, speed: int) -> None:
+        self._write(self.encoder.encode_fan_speed(port, speed))
+
     def read_out(self, length: int = 64) -> bytearray:
         """****これいるの?****"""
-        return self.endpoint_out.read(length)
+        return self._read(length)
 
     def write_in(self, data: list, length: int = 64) -> None:
         """****これいるの?****"""
-        self.endpoint_in.write(self._populate_partial_data_array(data, length))
+        self._write(self._populate_partial_data_array(data, length))
 
     def read_in(self, length: int = 64) -> bytearray:
-        return self.endpoint_in.read(length)
+        return self._read(length)
+
+    def query(self, data: list, length: int = 64, max_reads: int = 4) -> bytearray:
+        """
+        data を書き込み, 先頭 (コマンドと port) が data と一致する応答を返す.
+        以前のコマンドに対する読まれていない応答は読み捨てる.
+        """
+        self.write_out(data, length)
+
+        header = list(data[:3])
+        for _ in range(max_reads):
+            reply = self.read_in(length)
+            if list(reply[:len(header)]) == header:
+                return reply
+            logger.debug(f'discarding unmatched reply {list(reply[:len(header)])}')
+        raise IOError(f'no reply matching {header}')
 
     def get_firmware_version(self):
         raise NotImplementedError
@@ -124,14 +217,14 @@ class ThermaltakeG3ControllerDriver(ThermaltakeControllerDriver):
     PRODUCT_ID_BASE = 0x1fa5
 
     def init(self, unit=1):
+        self.unit = unit
         self.product_id = self.PRODUCT_ID_BASE + (unit - 1)
 
     def init_controller(self):
         self.write_out(TT_RGB_PLUS.COMMAND.INIT)
 
     def get_firmware_version(self):
-        self.write_out(TT_RGB_PLUS.COMMAND.GET_FIRMWARE_VERSION)
-        return self.read_in()
+        return self.query(TT_RGB_PLUS.COMMAND.GET_FIRMWARE_VERSION)
 
     def save_profile(self):
         self.write_out(TT_RGB_PLUS.COMMAND.SAVE_PROFILE)
@@ -141,14 +234,14 @@ class ThermaltakeTTSync5ControllerDriver(ThermaltakeControllerDriver):
     PRODUCT_ID_BASE = 0x1fa5
 
     def init(self, unit=1):
+        self.unit = unit
         self.product_id = self.PRODUCT_ID_BASE + (unit - 1)
 
     def init_controller(self):
         self.write_out(TT_RGB_PLUS.COMMAND.INIT)
 
     def get_firmware_version(self):
-        self.write_out(TT_RGB_PLUS.COMMAND.GET_FIRMWARE_VERSION)
-        return self.read_in()
+        return self.query(TT_RGB_PLUS.COMMAND.GET_FIRMWARE_VERSION)
 
     def save_profile(self):
         self.write_out(TT_RGB_PLUS.COMMAND.SAVE_PROFILE)
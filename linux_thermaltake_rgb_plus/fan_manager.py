@@ -1,21 +1,35 @@
 import time
-from threading import Thread
-
-import numpy as np
-from psutil import sensors_temperatures
 
 from linux_thermaltake_rgb_plus import Model, Manager
 from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.metrics import FAN_TICKS
+from linux_thermaltake_rgb_plus.scheduler import FrameClock
+from linux_thermaltake_rgb_plus.sensors import sensor_service
+from linux_thermaltake_rgb_plus.util import lazy_import
+
+# asyncio は run_async を, numpy は curve を使うときにだけ読み込む
+asyncio = lazy_import('asyncio')
+np = lazy_import('numpy')
 
 
 class FanModel(Model):
+    sensor_name = None
+    # 最後に読んだ温度. センサを使わない model では None のまま
+    last_temp = None
+    # これより古いセンサの snapshot は読み直す. None なら SensorService の interval
+    sensor_max_age = None
+
     @classmethod
     def factory(cls, config):
-        subclass_dict = {clazz.model: clazz for clazz in cls.inheritors()}
         try:
-            return subclass_dict.get(config.pop('model').lower())(config)
-        except KeyError as e:
-            logger.warn('%s not found in config item', e)
+            model = config.pop('model')
+        except KeyError:
+            raise ValueError(f'model not found in config item {config}')
+
+        clazz = cls.lookup(str(model))
+        if clazz is None:
+            raise ValueError(f'fan model {model} not found')
+        return clazz(config)
 
     def main(self):
         """
@@ -23,6 +37,16 @@ class FanModel(Model):
         """
         raise NotImplementedError
 
+    async def main_async(self, executor=None):
+        """
+        main() の async 版. センサの読み出しで event loop を止めないよう executor で実行する.
+        """
+        return await asyncio.get_running_loop().run_in_executor(executor, self.main)
+
+    def _get_temp(self):
+        self.last_temp = sensor_service.get_temp(self.sensor_name, self.sensor_max_age)
+        return self.last_temp
+
 
 class TempTargetModel(FanModel):
     model = 'temp_target'
@@ -32,6 +56,7 @@ class TempTargetModel(FanModel):
         self.target = float(config.get('target'))
         self.multiplier = config.get('multiplier', 5)
         self.last_speed = 10
+        sensor_service.subscribe(self.sensor_name)
 
     def main(self):
         temp = self._get_temp()
@@ -45,9 +70,6 @@ class TempTargetModel(FanModel):
         logger.debug(f'Temperature is {temp}°C, setting fan speed to {speed}%')
         return speed
 
-    def _get_temp(self):
-        return sensors_temperatures().get(self.sensor_name)[0].current
-
     def __str__(self) -> str:
         return f'target {self.target}°C on sensor {self.sensor_name}'
 
@@ -69,9 +91,171 @@ class LockedSpeedModel(FanModel):
         return f'locked speed {self.speed}%'
 
 
+class PIDModel(FanModel):
+    """
+    target °C を保つよう PID 制御で回転数を決める.
+    積分は出力が飽和している方向には貯めない (anti-windup), 微分は温度に対してとり 1 次遅れで均す.
+    ::: settings: [target, kp, ki, kd, derivative_tau, min_speed, max_speed, sensor_name]
+    """
+    model = 'pid'
+
+    def __init__(self, config):
+        self.sensor_name = config.get('sensor_name', 'coretemp')
+        self.target = float(config.get('target'))
+        self.kp = float(config.get('kp', 4.0))
+        self.ki = float(config.get('ki', 0.1))
+        self.kd = float(config.get('kd', 2.0))
+        # 微分項の filter の時定数 (秒)
+        self.derivative_tau = float(config.get('derivative_tau', 3.0))
+        self.min_speed = float(config.get('min_speed', 0))
+        self.max_speed = float(config.get('max_speed', 100))
+        if not 0 <= self.min_speed <= self.max_speed <= 100:
+            raise ValueError(f'PID speed limits must satisfy 0 <= min_speed <= max_speed <= 100, '
+                             f'got {self.min_speed}, {self.max_speed}')
+        sensor_service.subscribe(self.sensor_name)
+
+        # 時刻の取得元. simulation では差し替える
+        self.clock = time.monotonic
+        self.reset()
+
+    def reset(self):
+        self._integral = 0.0
+        self._derivative = 0.0
+        self._prev_temp = None
+        self._prev_time = None
+
+    def main(self):
+        temp = self._get_temp()
+        now = self.clock()
+        error = temp - self.target
+
+        dt = 0.0 if self._prev_time is None else now - self._prev_time
+        if dt > 0:
+            # 目標値の変化で跳ねないよう, 微分は error ではなく温度に対してとる
+            raw = (temp - self._prev_temp) / dt
+            alpha = dt / (self.derivative_tau + dt)
+            self._derivative += alpha * (raw - self._derivative)
+        self._prev_temp = temp
+        self._prev_time = now
+
+        unclamped = self.kp * error + self.ki * (self._integral + error * dt) \
+            + self.kd * self._derivative
+        speed = min(max(unclamped, self.min_speed), self.max_speed)
+
+        # 出力が飽和していて, さらにその方向へ積分が進む場合は積分しない
+        if not ((unclamped > self.max_speed and error > 0)
+                or (unclamped < self.min_speed and error < 0)):
+            self._integral += error * dt
+
+        logger.debug(f'Temperature is {temp}°C, setting fan speed to {speed}%')
+        return speed
+
+    def __str__(self) -> str:
+        return f'pid target {self.target}°C (kp {self.kp}, ki {self.ki}, kd {self.kd}) ' \
+               f'on sensor {self.sensor_name}'
+
+
+def monotone_cubic_interp(x, xp, fp):
+    """
+    Fritsch-Carlson の単調 3 次補間. fp が単調なら補間結果も単調になり, 点の間で行き過ぎない.
+    範囲外は np.interp と同じく端の値にする.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    xp = np.asarray(xp, dtype=np.float64)
+    fp = np.asarray(fp, dtype=np.float64)
+    if len(xp) < 3:
+        return np.interp(x, xp, fp)
+
+    h = np.diff(xp)
+    delta = np.diff(fp) / h
+
+    m = np.empty_like(fp)
+    m[0] = delta[0]
+    m[-1] = delta[-1]
+    m[1:-1] = (delta[:-1] + delta[1:]) / 2
+    m[1:-1][delta[:-1] * delta[1:] <= 0] = 0
+
+    for k in range(len(delta)):
+        if delta[k] == 0:
+            m[k] = m[k + 1] = 0
+            continue
+        alpha = m[k] / delta[k]
+        beta = m[k + 1] / delta[k]
+        norm = alpha ** 2 + beta ** 2
+        if norm > 9:
+            tau = 3 / np.sqrt(norm)
+            m[k] = tau * alpha * delta[k]
+            m[k + 1] = tau * beta * delta[k]
+
+    k = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    t = (np.clip(x, xp[0], xp[-1]) - xp[k]) / h[k]
+    t2 = t * t
+    t3 = t2 * t
+    return ((2 * t3 - 3 * t2 + 1) * fp[k] + (t3 - 2 * t2 + t) * h[k] * m[k]
+            + (-2 * t3 + 3 * t2) * fp[k + 1] + (t3 - t2) * h[k] * m[k + 1])
+
+
+class CompiledCurve:
+    """
+    fan curve を resolution °C 刻みの table にしたもの. tick ごとの計算は隣り合う 2 つの cell の間を
+    線形補間するだけで NumPy は使わない. linear の curve は点が table の刻みに乗っていれば np.interp と
+    一致する.
+    温度が上がるときは rising, 下がるときは hysteresis °C だけずらした falling を使い,
+    境界の温度で回転数が行ったり来たりしないようにする.
+    """
+    INTERPOLATIONS = ('linear', 'monotone_cubic')
+
+    def __init__(self, temps, speeds, hysteresis: float = 0.0, interpolation: str = 'linear',
+                 temp_range=(0.0, 150.0), resolution: float = 0.1):
+        if interpolation not in self.INTERPOLATIONS:
+            raise ValueError(f'unknown curve interpolation {interpolation}, '
+                             f'should be one of {self.INTERPOLATIONS}')
+        if hysteresis < 0:
+            raise ValueError(f'Fan curve hysteresis should be positive, got {hysteresis}')
+
+        self.t_min = float(min(temp_range[0], temps[0]))
+        self.t_max = float(max(temp_range[1], temps[-1]))
+        self.resolution = resolution
+        self.hysteresis = hysteresis
+        self._scale = 1.0 / resolution
+
+        interp = np.interp if interpolation == 'linear' else monotone_cubic_interp
+        grid = self.t_min + np.arange(int(round((self.t_max - self.t_min) * self._scale)) + 1) \
+            * resolution
+        self.rising = np.clip(interp(grid, temps, speeds), 0, 100).tolist()
+        self.falling = np.clip(interp(grid + hysteresis, temps, speeds), 0, 100).tolist()
+        self._last_index = len(self.rising) - 1
+        self._speed = None
+
+    def __call__(self, temp: float) -> float:
+        x = (temp - self.t_min) * self._scale
+        if x <= 0.0:
+            i, frac = 0, 0.0
+        elif x >= self._last_index:
+            i, frac = self._last_index, 0.0
+        else:
+            i = int(x)
+            frac = x - i
+
+        rising = self.rising[i]
+        if frac:
+            rising += (self.rising[i + 1] - rising) * frac
+        if self._speed is None or rising > self._speed:
+            self._speed = rising
+            return rising
+
+        falling = self.falling[i]
+        if frac:
+            falling += (self.falling[i + 1] - falling) * frac
+        if falling < self._speed:
+            self._speed = falling
+        return self._speed
+
+
 class CurveModel(FanModel):
     """
     ユーザ指定の温度, スピードに基づいた fan curve
+    ::: settings: [points, sensor_name, hysteresis, interpolation, temp_range]
     """
     model = 'curve'
 
@@ -80,6 +264,7 @@ class CurveModel(FanModel):
         self.temps = self.points[:, 0]
         self.speeds = self.points[:, 1]
         self.sensor_name = config.get('sensor_name', 'coretemp')
+        sensor_service.subscribe(self.sensor_name)
         logger.debug(f'curve fan points: {self.points}')
 
         if np.min(self.speeds) < 0:
@@ -94,66 +279,249 @@ class CurveModel(FanModel):
             raise ValueError(f'Curve fan speeds should be monotonically increasing, '
                              'configuration error ?')
 
+        self.curve = CompiledCurve(self.temps, self.speeds,
+                                   hysteresis=float(config.get('hysteresis', 0)),
+                                   interpolation=config.get('interpolation', 'linear'),
+                                   temp_range=config.get('temp_range', (0, 150)))
+
     def main(self):
         """
         現在の温度に対応する回転数を返す
         """
         temp = self._get_temp()
-        speed = np.interp(x=temp, xp=self.temps, fp=self.speeds)
-
-        if speed < 0:
-            speed = 0
-        if speed > 100:
-            speed = 100
+        speed = self.curve(temp)
 
         logger.debug(f'Temperature is {temp}°C, setting fan speed to {speed}%')
         return speed
 
-    def _get_temp(self):
-        return sensors_temperatures().get(self.sensor_name)[0].current
-
     def __str__(self) -> str:
         return f'curve {self.points}'
 
 
+class FanWritePolicy:
+    """
+    fan へ書き込むかどうかを決める.
+        deadband: 前回書き込んだ値との差がこれ (%) 未満なら書き込まない
+        max_slew: 1 秒あたりに変えてよい最大の量 (%)
+        min_interval: 書き込みの最小間隔 (秒)
+        emergency_temp: 温度がこれ (°C) 以上なら上の制限を無視してすぐに書き込む
+    saved は制限がなければ書き込んでいた回数.
+    """
+
+    def __init__(self, deadband: float = 0.0, max_slew: float = None, min_interval: float = 0.0,
+                 emergency_temp: float = None, clock=time.monotonic):
+        self.deadband = deadband
+        self.max_slew = max_slew
+        self.min_interval = min_interval
+        self.emergency_temp = emergency_temp
+        self.clock = clock
+
+        self.last_speed = None
+        self._last_write = None
+        self.writes = 0
+        self.saved = 0
+        self.emergency_writes = 0
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(deadband=float(config.get('deadband', 0)),
+                   max_slew=config.get('max_slew'),
+                   min_interval=float(config.get('min_interval', 0)),
+                   emergency_temp=config.get('emergency_temp'))
+
+    def apply(self, speed: float, temp: float = None):
+        """
+        書き込むべき回転数 (int) を返す. 書き込まない場合は None.
+        """
+        now = self.clock()
+        target = int(round(speed))
+        if target == self.last_speed:
+            return None
+
+        if self.last_speed is None:
+            return self._write(target, now)
+
+        if self.emergency_temp is not None and temp is not None and temp >= self.emergency_temp:
+            self.emergency_writes += 1
+            return self._write(target, now)
+
+        if now - self._last_write < self.min_interval:
+            self.saved += 1
+            return None
+
+        if self.max_slew is not None:
+            step = self.max_slew * (now - self._last_write)
+            target = int(round(min(max(target, self.last_speed - step), self.last_speed + step)))
+
+        if abs(target - self.last_speed) < self.deadband or target == self.last_speed:
+            self.saved += 1
+            return None
+
+        return self._write(target, now)
+
+    def _write(self, speed, now):
+        self.last_speed = speed
+        self._last_write = now
+        self.writes += 1
+        return speed
+
+    def __str__(self) -> str:
+        return f'{self.writes} writes, {self.saved} saved, {self.emergency_writes} emergency'
+
+
+class AdaptivePolling:
+    """
+    温度の変化の速さに応じて fan の tick の間隔を決める.
+    変化が rate_high (°C/s) 以上なら min_interval 秒, rate_low 以下なら max_interval 秒まで
+    backoff 倍ずつ間隔を延ばす. 温度の変化速度は符号付きのまま均すので, センサの 1°C の揺れは打ち消し合う.
+    """
+    SETTINGS = ('min_interval', 'max_interval', 'rate_high', 'rate_low', 'backoff', 'smoothing')
+
+    def __init__(self, min_interval: float = 0.1, max_interval: float = 5.0,
+                 rate_high: float = 1.0, rate_low: float = 0.1, backoff: float = 1.5,
+                 smoothing: float = 2.0, clock=time.monotonic):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(f'polling intervals must satisfy 0 < min_interval <= max_interval, '
+                             f'got {min_interval}, {max_interval}')
+        if not 0 <= rate_low < rate_high:
+            raise ValueError(f'polling rates must satisfy 0 <= rate_low < rate_high, '
+                             f'got {rate_low}, {rate_high}')
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate_high = rate_high
+        self.rate_low = rate_low
+        self.backoff = backoff
+        # 変化速度を均す時定数 (秒)
+        self.smoothing = smoothing
+        self.clock = clock
+
+        self.interval = min_interval
+        self.rate = 0.0
+        self._prev_temp = None
+        self._prev_time = None
+
+    @classmethod
+    def from_config(cls, config: dict, setting_name: str = None):
+        """
+        config.yml の fan manager の polling 項目から作る. setting_name はエラーに出す manager の名前.
+        """
+        if not isinstance(config, dict):
+            raise ValueError(f'polling of fan manager {setting_name} should be a mapping, '
+                             f'got {config!r}')
+        unknown = [key for key in config if key not in cls.SETTINGS]
+        if unknown:
+            raise ValueError(f'unknown polling settings {unknown} in fan manager {setting_name}, '
+                             f'should be some of {cls.SETTINGS}')
+        return cls(**{key: float(value) for key, value in config.items()})
+
+    def update(self, temp: float) -> float:
+        """
+        新しい温度を渡し, 次の tick までの間隔 (秒) を返す.
+        """
+        now = self.clock()
+        if self._prev_time is not None and now > self._prev_time:
+            dt = now - self._prev_time
+            alpha = dt / (self.smoothing + dt)
+            self.rate += alpha * ((temp - self._prev_temp) / dt - self.rate)
+        self._prev_temp = temp
+        self._prev_time = now
+
+        rate = abs(self.rate)
+        if rate >= self.rate_high:
+            # 急な変化にはすぐに追いつく
+            self.interval = self.min_interval
+            return self.interval
+
+        if rate <= self.rate_low:
+            target = self.max_interval
+        else:
+            ratio = (self.rate_high - rate) / (self.rate_high - self.rate_low)
+            target = self.min_interval + (self.max_interval - self.min_interval) * ratio
+        self.interval = min(max(target, self.min_interval), self.interval * self.backoff)
+        return self.interval
+
+
 class FanManager(Manager):
-    def __init__(self, initial_model: FanModel = None, name: str = None):
-        super().__init__(initial_model, name)
-        self._continue = False
-        self._thread = Thread(target=self._main_loop)
+    tick_interval = 1.0
+    _task = None
+
+    def __init__(self, initial_model: FanModel = None, name: str = None, scheduler=None):
+        super().__init__(initial_model, name, scheduler)
+        self.write_policy = FanWritePolicy()
+        self.polling = None
+        self.interval = self.tick_interval
+        self._task = None
+        self._ticks = FAN_TICKS.labels(self._name)
         logger.debug(f'creating FanManager object: [Model: {initial_model}]')
 
+    def configure(self, config: dict):
+        self.write_policy = FanWritePolicy.from_config(config.get('write_policy') or {})
+        if config.get('polling'):
+            self.polling = AdaptivePolling.from_config(config['polling'], self._name)
+
     def set_model(self, model: FanModel):
+        """
+        動いている manager でも次の tick から model が変わる. tick と同じスレッドから呼ぶこと.
+        """
         logger.debug(f'setting fan model: {model.__class__.__name__}')
         if isinstance(model, FanModel):
             logger.debug(f'SUCCESS: set fan model: {model.__class__.__name__}')
+            if self._task is not None:
+                # adaptive polling が決めた間隔を引き継ぐ
+                model.sensor_max_age = self._model.sensor_max_age
             self._model = model
 
-    def _main_loop(self):
-        last_speed = None
-        while self._contine:
-            speed = int(round(self._model.main()))
-
-            hoge = None
+    def _tick(self):
+        self._ticks.inc()
+        self._set_speed(self._model.main())
+        self._adapt_interval()
+
+    def _adapt_interval(self):
+        temp = self._model.last_temp
+        if self.polling is None or temp is None:
+            return
+
+        interval = self.polling.update(temp)
+        if interval != self.interval:
+            logger.debug(f'{self._name} fan tick interval {self.interval:.2f}s -> {interval:.2f}s')
+            self.interval = interval
+            # tick の間はセンサの snapshot を読み直させる
+            self._model.sensor_max_age = interval
+            if self._task is not None:
+                self._task.set_period(interval)
+
+    def _set_speed(self, speed):
+        speed = self.write_policy.apply(speed, self._model.last_temp)
+
+        if speed is not None:
+            logger.debug(f'new fan speed {speed}')
             for dev in self._devices:
-                hoge = dev.get_fan_speed()
-                logger.debug(f'now fan speed {hoge}')
-
-            if last_speed != speed:
-                last_speed = speed
-                logger.debug(f'new fan speed {speed}')
-                for dev in self._devices:
-                    dev.set_fan_speed(speed)
-            time.sleep(1)
-        logger.debug(f'exiting {self.__class__.__name__} main loop')
+                dev.set_fan_speed(speed)
 
     def start(self):
         logger.info(f'Starting fan manager ({self._model})...')
-        self._contine = True
-        self._thread.start()
+        if self._scheduler is None:
+            raise RuntimeError('scheduler not set')
+        self._task = self._scheduler.schedule(self._tick, self.interval,
+                                              name=f'{self._name} fan tick')
 
     def stop(self):
-        logger.info(f'Stopping fan manager...')
-        self._continue = False
-        self._thread.join()
+        logger.info(f'Stopping fan manager... ({self.write_policy})')
+        if self._task is not None:
+            self._scheduler.cancel(self._task)
+            self._task = None
 
+    async def run_async(self, executor=None):
+        """
+        scheduler の代わりに event loop 上で tick を回す. cancel されるまで返らない.
+        """
+        logger.info(f'Starting fan manager ({self._model})...')
+        clock = FrameClock(self.interval)
+        while True:
+            clock.begin()
+            self._ticks.inc()
+            self._set_speed(await self._model.main_async(executor))
+            self._adapt_interval()
+
+            clock.period = self.interval
+            await asyncio.sleep(max(0.0, clock.advance() - time.monotonic()))
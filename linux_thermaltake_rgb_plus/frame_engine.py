@@ -0,0 +1,78 @@
+from linux_thermaltake_rgb_plus.color import hsv_to_grb
+from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS
+from linux_thermaltake_rgb_plus.util import lazy_import
+
+np = lazy_import('numpy')
+
+
+class FrameEngine:
+    """
+    全ての RGB device の LED を 1 つの (n_leds, 3) の uint8 配列 (g, r, b) で持つ.
+    effect はこの配列に vectorized に書き込み, flush() で device ごとの payload を切り出して送る.
+    """
+
+    def __init__(self, devices):
+        self.devices = [dev for dev in devices if getattr(dev, 'num_leds', 0)]
+        self._slices = {}
+
+        start = 0
+        led_index = []
+        for dev in self.devices:
+            self._slices[dev] = slice(start, start + dev.num_leds)
+            led_index.extend(range(dev.num_leds))
+            start += dev.num_leds
+
+        self.leds = np.zeros((start, 3), dtype=np.uint8)
+        # device 内での LED の番号
+        self.led_index = np.array(led_index, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.leds)
+
+    def view(self, dev) -> 'np.ndarray':
+        """
+        dev の LED に対応する (num_leds, 3) の view. 書き込むと self.leds も変わる.
+        """
+        return self.leds[self._slices[dev]]
+
+    def fill(self, grb) -> None:
+        self.leds[:] = grb
+
+    def fill_hsv(self, h, s=1.0, v=1.0) -> None:
+        """
+        h, s, v はスカラーか, LED の数と同じ長さの配列.
+        """
+        self.leds[:] = hsv_to_grb(h, s, v)
+
+    def fill_per_led(self, grbs) -> None:
+        """
+        grbs[i] を全ての device の i 番目の LED に書き込む.
+        """
+        grbs = np.asarray(grbs, dtype=np.uint8)
+        self.leds[:] = grbs[self.led_index % len(grbs)]
+
+    def fill_gradient(self, start_grb, end_grb) -> None:
+        """
+        各 device の最初の LED から最後の LED まで, start_grb から end_grb への gradient にする.
+        """
+        num_leds = np.array([dev.num_leds for dev in self.devices], dtype=np.float64)
+        per_led = np.repeat(num_leds, num_leds.astype(np.intp))
+        ratio = (self.led_index / np.maximum(per_led - 1, 1))[:, np.newaxis]
+        start_grb = np.asarray(start_grb, dtype=np.float64)
+        end_grb = np.asarray(end_grb, dtype=np.float64)
+        self.leds[:] = start_grb + (end_grb - start_grb) * ratio
+
+    def payloads(self):
+        """
+        (device, payload) を返す. payload は frame 全体の bytes を 1 回だけ作り,
+        そこから copy せずに切り出した memoryview. 書き込みはキューに入るので, 次の frame を
+        書いても送られる前の payload は変わらない.
+        """
+        frame = memoryview(self.leds.tobytes())
+        for dev in self.devices:
+            s = self._slices[dev]
+            yield dev, frame[s.start * 3:s.stop * 3]
+
+    def flush(self, mode=TT_RGB_PLUS.RGB_MODE.PER_LED, speed=0x00) -> None:
+        for dev, payload in self.payloads():
+            dev.set_lighting(values=payload, mode=mode, speed=speed)
@@ -4,6 +4,8 @@ PROTOCOL_SET = 0x32
 PROTOCOL_FAN = 0x51
 PROTOCOL_LIGHT = 0x52
 
+PACKET_LENGTH = 64
+
 
 class TT_RGB_PLUS:
     # https://github.com/MoshiMoshi0/ttrgbplusapi
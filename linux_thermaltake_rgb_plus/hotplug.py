@@ -0,0 +1,49 @@
+from linux_thermaltake_rgb_plus import logger
+
+
+class HotplugMonitor:
+    """
+    offline になった controller を interval 秒ごとに開き直してみる.
+    開き直しは各 controller の I/O スレッドで行うので, scheduler は USB の reset を待たない.
+    全ての controller が online の間は, 1 回の poll は online かどうかを見るだけで終わる.
+    """
+
+    def __init__(self, controllers: dict, interval: float = 2.0):
+        self.controllers = controllers
+        self.interval = interval
+        self._attempts = {}
+        self._task = None
+        self._scheduler = None
+
+    def start(self, scheduler):
+        self._scheduler = scheduler
+        self._task = scheduler.schedule(self.poll, self.interval, name='hotplug')
+
+    def stop(self):
+        if self._task is not None:
+            self._scheduler.cancel(self._task)
+            self._task = None
+
+    def poll(self):
+        for unit, controller in self.controllers.items():
+            if controller.online:
+                continue
+
+            attempt = self._attempts.get(unit)
+            if attempt is not None and not attempt.done():
+                # 前回の開き直しがまだ終わっていない
+                continue
+
+            if attempt is None:
+                logger.info(f'controller {unit} is offline, waiting for it to come back')
+            self._attempts[unit] = future = controller.reattach()
+            future.add_done_callback(lambda future, unit=unit: self._on_reattach(unit, future))
+
+    def _on_reattach(self, unit, future):
+        e = future.exception()
+        if e is None:
+            logger.info(f'controller {unit} reattached')
+            self._attempts.pop(unit, None)
+        else:
+            # 抜かれている間は毎回失敗するので info には出さない
+            logger.debug(f'controller {unit} not back yet: {e}')
@@ -0,0 +1,174 @@
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.transport import is_disconnect
+
+
+class ControllerIOWorker:
+    """
+    1 つの controller に対する USB の読み書きを 1 本のスレッドにまとめる.
+    同じ key (port, コマンドの種類) の書き込みがまだ送られていなければ新しいもので上書きし,
+    最新の lighting frame / fan duty だけを送る (latest-wins).
+    controller が抜かれた (または max_errors 回続けて失敗した) ら offline にし, reattach() で開き
+    直せるまではコマンドをキューに入れない. 開き直したら key ごとの最後の submit() を送り直す.
+    """
+
+    def __init__(self, driver, name: str = None, max_errors: int = 5, online: bool = True):
+        self._driver = driver
+        self.max_errors = max_errors
+        # False なら device がまだ開かれていない. reattach() で開く
+        self.online = online
+        self._reattaching = None
+        self._errors = 0
+        # key ごとの最後の submit(). 開き直したときに送り直す
+        self._last = {}
+        self._pending = OrderedDict()
+        self._cond = Condition()
+        self._seq = itertools.count()
+        self._continue = False
+        self._thread = Thread(target=self._main_loop, name=name, daemon=True)
+
+    def start(self):
+        self._continue = True
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        キューに残っているコマンドを全て送ってからスレッドを止める.
+        offline なら送るものはないので, 開き直している途中でも待たない.
+        """
+        with self._cond:
+            self._continue = False
+            self._cond.notify()
+        if self._thread.is_alive() and self.online:
+            self._thread.join(timeout)
+
+    def write(self, data, key=None) -> None:
+        """
+        data を書き込むようキューに入れる. key が None のものは上書きされない.
+        """
+        if key is None:
+            key = next(self._seq)
+        self._put(key, self._driver.write_out, (data,), None)
+
+    def submit(self, key, func, *args, future: Future = None) -> None:
+        """
+        func(*args) を I/O スレッド上で実行する. key が同じものがまだ実行されていなければ上書きする.
+        future を渡すと, 実際に送られた (上書きされた場合は上書きした方が送られた) ときに完了する.
+        """
+        self._put(key, func, args, future, remember=True)
+
+    def query(self, data) -> Future:
+        """
+        data を書き込み, それに対する応答を読む. 応答は返り値の Future で受け取る.
+        """
+        future = Future()
+        self._put(next(self._seq), self._driver.query, (data,), future)
+        return future
+
+    def call(self, func, *args) -> Future:
+        """
+        driver に対する任意の処理を I/O スレッド上で実行する.
+        """
+        future = Future()
+        self._put(next(self._seq), func, args, future)
+        return future
+
+    def reattach(self, func) -> Future:
+        """
+        offline の間に func (device を開き直す処理) を I/O スレッド上で実行する.
+        前の呼び出しがまだ終わっていなければ, その Future を返す.
+        成功したら online に戻し, key ごとの最後の submit() をキューに入れ直す.
+        """
+        with self._cond:
+            if self._reattaching is not None and not self._reattaching.done():
+                # 開き直している途中なら同じ Future を返し, 2 回 reset しない
+                return self._reattaching
+            self._reattaching = future = Future()
+            # offline でもキューに入れる
+            self._pending[next(self._seq)] = (self._reattach, (func,), [future])
+            self._cond.notify()
+        return future
+
+    def _reattach(self, func):
+        func()
+        with self._cond:
+            self.online = True
+            self._errors = 0
+            for key, (last_func, args) in self._last.items():
+                if key not in self._pending:
+                    self._pending[key] = (last_func, args, [])
+            self._cond.notify()
+        logger.info(f'{self._thread.name}: controller is back online, '
+                    f'replaying {len(self._last)} commands')
+
+    def _put(self, key, func, args, future, remember=False):
+        futures = [] if future is None else [future]
+        with self._cond:
+            if remember:
+                self._last[key] = (func, args)
+            online = self.online
+            if online:
+                previous = self._pending.get(key)
+                if previous is not None:
+                    # 上書きされたものを待っていた呼び出し元には, 上書きした方の完了を知らせる
+                    futures = previous[2] + futures
+                # 上書きされてもキュー中の位置は変えない
+                self._pending[key] = (func, args, futures)
+                self._cond.notify()
+        if not online:
+            # 開き直したときに _last から送り直すので, 今は送らない
+            self._fail(futures)
+
+    def _main_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and self._continue:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                _, (func, args, futures) = self._pending.popitem(last=False)
+
+            futures = [future for future in futures if future.set_running_or_notify_cancel()]
+
+            try:
+                result = func(*args)
+            except Exception as e:
+                if self.online:
+                    logger.error(f'{func.__name__} failed: {e}')
+                else:
+                    # 抜かれている間の開き直しは失敗し続けるので error にはしない
+                    logger.debug(f'{func.__name__} failed: {e}')
+                for future in futures:
+                    future.set_exception(e)
+                self._on_error(e)
+                continue
+
+            self._errors = 0
+            for future in futures:
+                future.set_result(result)
+
+        logger.debug(f'exiting {self.__class__.__name__} main loop')
+
+    def _on_error(self, e: Exception):
+        if not self.online:
+            return
+        self._errors += 1
+        if not is_disconnect(e) and self._errors < self.max_errors:
+            return
+
+        with self._cond:
+            self.online = False
+            dropped = [future for _, _, futures in self._pending.values() for future in futures]
+            self._pending.clear()
+        self._fail(dropped)
+        logger.warning(f'{self._thread.name}: controller went offline ({e})')
+
+    @staticmethod
+    def _fail(futures):
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError('controller is offline'))
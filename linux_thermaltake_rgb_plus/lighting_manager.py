@@ -1,13 +1,22 @@
+import socket
 import time
 from collections import namedtuple
-from threading import Thread
+from threading import Event, Lock, Thread
 import math
 
-from psutil import sensors_temperatures
-
 from linux_thermaltake_rgb_plus import Model, Manager
-from linux_thermaltake_rgb_plus import logger, util
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.color import ColorLUT
+from linux_thermaltake_rgb_plus.frame_engine import FrameEngine
 from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS
+from linux_thermaltake_rgb_plus.metrics import STREAM_FRAMES
+from linux_thermaltake_rgb_plus.scheduler import FrameClock
+from linux_thermaltake_rgb_plus.sensors import sensor_service
+from linux_thermaltake_rgb_plus.util import lazy_import, parse_mode
+from linux_thermaltake_rgb_plus.util import bind_unix_socket, unlink_unix_socket
+
+# run_async を使うときにだけ読み込む
+asyncio = lazy_import('asyncio')
 
 
 def compass_to_rgb(h, s=1, v=1):
@@ -48,18 +57,35 @@ class LightingEffect(Model):
     def __init__(self, config):
         self._config = config
         self._devices = []
+        self._frame_engine = None
+        self._scheduler = None
         logger.info(f'initializing {self.__class__.__name__} light controller')
 
     @classmethod
     def factory(cls, config: dict):
-        subclass_dict = {clazz.model: clazz for clazz in cls.inheritors()}
         try:
-            return subclass_dict.get(config.pop('model').lower())(config)
-        except KeyError as e:
-            logger.warn('%s not found in config item', e)
+            model = config.pop('model')
+        except KeyError:
+            raise ValueError(f'model not found in config item {config}')
+
+        clazz = cls.lookup(str(model))
+        if clazz is None:
+            raise ValueError(f'lighting effect {model} not found')
+        return clazz(config)
 
     def set_devices(self, devices):
         self._devices = devices
+        self._frame_engine = None
+
+    @property
+    def _engine(self) -> FrameEngine:
+        # numpy は frame を組み立てる effect が最初に使ったときに読み込まれる
+        if self._frame_engine is None:
+            self._frame_engine = FrameEngine(self._devices)
+        return self._frame_engine
+
+    def set_scheduler(self, scheduler):
+        self._scheduler = scheduler
 
     def start(self):
         raise NotImplementedError
@@ -67,48 +93,86 @@ class LightingEffect(Model):
     def stop(self):
         return
 
+    async def run_async(self, executor=None):
+        """
+        event loop 上で effect を動かす. 書き込みはキューに入れるだけなので start() をそのまま呼ぶ.
+        """
+        self.start()
+
 
 class CustomLightingEffect(LightingEffect):
+    """
+    ::: settings: [speed or fps, frame_policy]
+    fps を指定した場合は speed より優先する.
+    """
     SLOW = 1
     NORMAL = 0.75
     FAST = 0.5
     EXTREME = 0.25
 
+    # effect ごとの既定の fps. None なら speed から決める.
+    fps = None
+
     def __init__(self, config):
         super().__init__(config)
-        conf_speed = self._config.get('speed', 'normal')
-        self._speed = getattr(self, conf_speed.upper())
+        fps = self._config.get('fps', self.fps)
+        if fps:
+            self._speed = 1.0 / float(fps)
+        else:
+            conf_speed = self._config.get('speed', 'normal')
+            self._speed = getattr(self, conf_speed.upper())
+        self._frame_policy = self._config.get('frame_policy', FrameClock.DROP)
 
     def start(self):
         raise NotImplementedError
 
 
 class ThreadedCustomLightingEffect(CustomLightingEffect):
+    """
+    _speed 秒ごとに next() を呼ぶ effect. 専用のスレッドは持たず, daemon の scheduler 上で動く.
+    """
     def __init__(self, config):
         super().__init__(config)
-        self._continue = False
-        self._thread = Thread(target=self._main_loop)
+        self._task = None
 
     def start(self):
-        self._continue = True
-        self._thread.start()
+        if self._scheduler is None:
+            raise RuntimeError('scheduler not set')
+        self.begin_all()
+        self._task = self._scheduler.schedule(self.next, self._speed, name=f'{self.model} frame',
+                                              policy=self._frame_policy)
 
     def stop(self):
-        self._continue = False
-        self._thread.join()
+        if self._task is not None:
+            logger.info(f'{self.model} frame clock: {self.frame_clock}')
+            self._scheduler.cancel(self._task)
+            self._task = None
+
+    @property
+    def frame_clock(self) -> FrameClock:
+        return self._task.clock if self._task is not None else None
 
     def begin_all(self):
         pass
 
-    def _main_loop(self):
-        self.begin_all()
-        while self._continue:
-            self.next()
-            time.sleep(self._speed)
-
     def next(self):
         raise NotImplementedError
 
+    async def next_async(self, executor=None):
+        """
+        next() の async 版. センサの読み出しで event loop を止めないよう executor で実行する.
+        """
+        await asyncio.get_running_loop().run_in_executor(executor, self.next)
+
+    async def run_async(self, executor=None):
+        clock = FrameClock(self._speed, self._frame_policy)
+        self.begin_all()
+        while True:
+            clock.begin()
+            await self.next_async(executor)
+
+            await asyncio.sleep(max(0.0, clock.advance() - time.monotonic()))
+
 
 class AlternatingLightEffect(CustomLightingEffect):
     """
@@ -124,14 +188,10 @@ class AlternatingLightEffect(CustomLightingEffect):
         self.even_rgb = self.RGBMap(**self._config.get('even_rgb'))
 
     def start(self):
-        for dev in self._devices:
-            values = []
-            for i in range(dev.num_leds):
-                if i % 2 == 0:
-                    values.extend(self.even_rgb)
-                else:
-                    values.extend(self.odd_rgb)
-            dev.set_lighting(values=values)
+        even = self._engine.led_index % 2 == 0
+        self._engine.leds[even] = self.even_rgb
+        self._engine.leds[~even] = self.odd_rgb
+        self._engine.flush()
 
     def __str__(self) -> str:
         return f'alternating lighting {self.odd_rgb} {self.even_rgb}'
@@ -139,7 +199,7 @@ class AlternatingLightEffect(CustomLightingEffect):
 
 class TemperatureLightingEffect(ThreadedCustomLightingEffect):
     """
-    ::: setting: [speed, cold, hot, target, sensor_name]
+    ::: setting: [speed, cold, hot, target, sensor_name, hue_steps]
     """
     model = 'thermal'
 
@@ -157,13 +217,14 @@ class TemperatureLightingEffect(ThreadedCustomLightingEffect):
         self.cur_temp = 0
         self.angle = 0
         self.sensor_name = self._config.get('sensor_name', 'coretemp')
+        sensor_service.subscribe(self.sensor_name)
+        # 彩度, 明度は固定なので色相だけの table にする
+        self._lut = ColorLUT(hue_steps=int(self._config.get('hue_steps', 360)),
+                             sat_steps=1, val_steps=1)
 
     def next(self):
-        def flatten(l):
-            return [item for sublist in l for item in sublist]  # NOTE: こんな書き方できるんか
-
         # NOTE: 本当に core 0 の温度だけで良いか
-        self.cur_temp = int(sensors_temperatures().get(self.sensor_name)[0].current)
+        self.cur_temp = int(sensor_service.get_temp(self.sensor_name))
         if self.cur_temp <= self.cold:
             self.angle = self.cold_angle
         elif self.cur_temp < self.target:
@@ -177,9 +238,8 @@ class TemperatureLightingEffect(ThreadedCustomLightingEffect):
             self.angle = (self.hot_angle * (self.cur_temp - self.target)
                           + self.target_angle * (self.hot - self.cur_temp)) * self._h_t
 
-        for dev in self._devices:
-            values = flatten([compass_to_rgb(self.angle)] * dev.num_leds)   # NOTE: なるほど
-            dev.set_lighting(values=values)
+        self._engine.fill(self._lut.lookup(self.angle))
+        self._engine.flush()
 
     def __str__(self) -> str:
         return f'temperature lighting'
@@ -229,15 +289,12 @@ class ColorsLightingEffect(LightingEffect):
                           ' the number of LED lights in the debice.')
                     raise ValueError
 
-            values = list(util.flatten_list(grbs))
-            for dev in self._devices:
-                dev.set_lighting(mode=mode, speed=speed, values=values)
+            self._engine.fill_per_led(grbs)
+            self._engine.flush(mode=mode, speed=speed)
 
         elif 'grb' in self._config.keys():
-            grb = self._config['grb']
-            for dev in self._devices:
-                values = list(util.flatten_list(grb * dev.num_leds))
-                dev.set_lighting(mode=mode, speed=speed, values=values)
+            self._engine.fill(self._config['grb'])
+            self._engine.flush(mode=mode, speed=speed)
         else:
             logger.warn('grb config is not existed.')
             raise ValueError            # NOTE: 正しいErrorにする
@@ -341,23 +398,184 @@ class WaveLightingEffect(ColorsLightingEffect):
         self._set_per_led(mode=TT_RGB_PLUS.RGB_MODE.WAVE, speed=self._speed)
 
 
+class StreamLightingEffect(ThreadedCustomLightingEffect):
+    """
+    ::: settings: [path, mode, fps, timeout, r, g, b]
+    別のプロセス (visualizer など) から unix datagram socket で送られた frame を device に送る.
+    1 つの datagram が 1 つの device の 1 frame で, 先頭の 2 byte が unit と port, 残りが
+    LED ごとの g, r, b.
+
+        sock.sendto(bytes([1, 2]) + grb_bytes, '/run/linux_thermaltake_rgb_plus/stream.sock')
+
+    受信スレッドは device ごとに最新の frame だけを裏の buffer に置き, frame ごとに表の buffer と
+    入れ替えて送る. 送る速さは fps までで, 間に上書きされた frame は dropped, 受け取ってから 1 frame
+    より長く待たされた frame は late として数える.
+    timeout 秒 frame が来なかった device は r, g, b の色にする.
+    """
+    model = 'stream'
+    fps = 60
+    DEFAULT_PATH = '/run/linux_thermaltake_rgb_plus/stream.sock'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.path = str(self._config.get('path', self.DEFAULT_PATH))
+        self.socket_mode = parse_mode(self._config.get('mode', 0o660))
+        self.timeout = float(self._config.get('timeout', 1.0))
+        self.fallback = [int(self._config.get('g', 0)), int(self._config.get('r', 0)),
+                         int(self._config.get('b', 0))]
+
+        self._targets = {}
+        self._back = {}
+        self._front = {}
+        self._lock = Lock()
+        self._last_received = {}
+        self._stalled = set()
+        self._socket = None
+        self._receiver = None
+        self._stop_receiving = Event()
+
+        self._received = STREAM_FRAMES.labels('received')
+        self._forwarded = STREAM_FRAMES.labels('forwarded')
+        self._dropped = STREAM_FRAMES.labels('dropped')
+        self._late = STREAM_FRAMES.labels('late')
+        self._invalid = STREAM_FRAMES.labels('invalid')
+
+    def begin_all(self):
+        self._targets = {(int(dev.controller.unit), int(dev.port)): dev
+                         for dev in self._devices if getattr(dev, 'num_leds', 0)}
+        # 最初の frame が timeout 秒来なければ fallback にする
+        now = time.monotonic()
+        self._last_received = {dev: now for dev in self._targets.values()}
+        self._stalled = set()
+        self._open()
+
+    def _open(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            # 同じ path の別の stream effect や別の daemon からは socket を奪わない
+            bind_unix_socket(self.path, self.socket_mode, self._socket.bind)
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            raise
+        # stop() に気づけるよう, 受信の待ちは短く区切る
+        self._socket.settimeout(0.2)
+
+        self._stop_receiving.clear()
+        self._receiver = Thread(target=self._receive_loop, name='stream-receiver', daemon=True)
+        self._receiver.start()
+        logger.info(f'receiving lighting frames on {self.path} for {len(self._targets)} devices')
+
+    def _close(self):
+        if self._receiver is None:
+            return
+        self._stop_receiving.set()
+        self._receiver.join()
+        self._receiver = None
+        self._socket.close()
+        self._socket = None
+        unlink_unix_socket(self.path)
+
+    def _receive_loop(self):
+        # 一番 LED の多い device の frame より長い datagram は切り詰められるので, 1 byte 余分に受ける
+        size = 2 + 3 * max((dev.num_leds for dev in self._targets.values()), default=0) + 1
+        while not self._stop_receiving.is_set():
+            try:
+                data = self._socket.recv(size)
+            except socket.timeout:
+                continue
+
+            dev = self._targets.get((data[0], data[1])) if len(data) > 2 else None
+            payload = memoryview(data)[2:]
+            if dev is None or len(payload) % 3 or len(payload) > dev.num_leds * 3:
+                self._invalid.inc()
+                continue
+
+            self._received.inc()
+            with self._lock:
+                if dev in self._back:
+                    # 送られる前に次の frame が来た
+                    self._dropped.inc()
+                self._back[dev] = (payload, time.monotonic())
+
+    def next(self):
+        with self._lock:
+            front, self._back = self._back, self._front
+
+        now = time.monotonic()
+        for dev, (payload, received) in front.items():
+            if now - received > self._speed:
+                self._late.inc()
+            self._last_received[dev] = received
+            self._stalled.discard(dev)
+            dev.set_lighting(values=payload, mode=TT_RGB_PLUS.RGB_MODE.PER_LED, speed=0x00)
+            self._forwarded.inc()
+        front.clear()
+        self._front = front
+
+        for dev, received in self._last_received.items():
+            if dev not in self._stalled and now - received > self.timeout:
+                logger.info(f'no stream frame for {dev.controller.unit}:{dev.port} '
+                            f'in {self.timeout}s, falling back')
+                self._stalled.add(dev)
+                dev.set_lighting(values=self.fallback, mode=TT_RGB_PLUS.RGB_MODE.FULL,
+                                 speed=0x00)
+
+    def stop(self):
+        super().stop()
+        self._close()
+        logger.info(f'stream frames: received {self._received.value} '
+                    f'forwarded {self._forwarded.value} dropped {self._dropped.value} '
+                    f'late {self._late.value} invalid {self._invalid.value}')
+
+    async def run_async(self, executor=None):
+        try:
+            await super().run_async(executor)
+        finally:
+            self._close()
+
+    def __str__(self) -> str:
+        return f'stream lighting {self.path}'
+
+
 class LightingManager(Manager):
-    def __init__(self, initial_model: LightingEffect = None, name: str = None):
-        super().__init__(initial_model, name)
+    running = False
+
+    def __init__(self, initial_model: LightingEffect = None, name: str = None, scheduler=None):
+        super().__init__(initial_model, name, scheduler)
         logger.debug(f'creating LightingManager object: [Model: {initial_model}]')
 
     def set_model(self, model: LightingEffect):
+        """
+        動いている manager なら前の effect を止めて新しい effect を始める.
+        scheduler のスレッドから呼ぶこと.
+        """
         logger.debug(f'setting fan model: {model.__class__.__name__}')
         if isinstance(model, LightingEffect):
             logger.debug(f'SUCESS: set lighting effect: {model.__class__.__name__}')
+            previous = self._model if self.running else None
             self._model = model
+            if previous is not None:
+                previous.stop()
+                self._start_model()
 
-    def start(self):
-        logger.info(f'Starting lighting manager ({self._model})...')
+    def _start_model(self):
         self._model.set_devices(self._devices)
+        self._model.set_scheduler(self._scheduler)
         self._model.start()
 
+    def start(self):
+        logger.info(f'Starting lighting manager ({self._model})...')
+        self.running = True
+        self._start_model()
+
     def stop(self):
         logger.info(f'Stopping lighting manager...')
+        self.running = False
         self._model.stop()
 
+    async def run_async(self, executor=None):
+        logger.info(f'Starting lighting manager ({self._model})...')
+        self._model.set_devices(self._devices)
+        await self._model.run_async(executor)
+
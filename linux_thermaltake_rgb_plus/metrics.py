@@ -0,0 +1,192 @@
+import errno
+from bisect import bisect_left
+
+from linux_thermaltake_rgb_plus import logger
+
+# 秒単位. USB の 1 転送 (~1 ms) から tick の大きな遅れまでを覆う
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labelnames, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # 最後の要素は +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    label の値ごとの child を持つ metric. 記録する側は labels() で child を 1 回だけ取り出して
+    持っておき, hot path では child.inc() / child.observe() だけを呼ぶ. lock も文字列の組み立ても
+    scrape されたときにしか行わない.
+    """
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.collect())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def collect(self):
+        for values, child in list(self._children.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, values)} {child.value}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def collect(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), list(child.counts)):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, (('le', _format_value(bound)),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, values)
+            yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+            yield f'{self.name}_count{labels} {child.count}'
+
+
+class CallbackMetric(Metric):
+    """
+    scrape されたときに func() を呼んで値を集める metric. func は (label の値の tuple, 値) を返す.
+    既にどこかで数えている値 (device の frames_suppressed など) はこれで出せば記録の手間はない.
+    """
+
+    def __init__(self, name: str, help: str, type: str, func, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.func = func
+
+    def collect(self):
+        for values, value in self.func():
+            yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str) -> None:
+        self._metrics.pop(name, None)
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, type: str, func, labelnames=()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, type, func, labelnames))
+
+    def render(self) -> str:
+        """
+        Prometheus の text format (0.0.4) で全ての metric を返す.
+        """
+        blocks = []
+        for metric in list(self._metrics.values()):
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                logger.warning(f'failed to collect metric {metric.name}: {e}')
+        return '\n'.join(blocks) + '\n'
+
+
+registry = Registry()
+
+USB_WRITES = registry.counter('thermaltake_usb_writes_total',
+                              'USB packets written to the controller', ('unit',))
+USB_READS = registry.counter('thermaltake_usb_reads_total',
+                             'USB packets read from the controller', ('unit',))
+USB_LATENCY = registry.histogram('thermaltake_usb_transfer_seconds',
+                                 'USB transfer latency', ('unit', 'direction'))
+USB_ERRORS = registry.counter('thermaltake_usb_errors_total',
+                              'failed USB transfers', ('unit', 'kind'))
+FAN_TICKS = registry.counter('thermaltake_fan_ticks_total',
+                             'fan manager ticks', ('manager',))
+TASK_LATENESS = registry.histogram('thermaltake_task_lateness_seconds',
+                                   'how late a scheduled task started after its deadline',
+                                   ('task',))
+SENSOR_READ = registry.histogram('thermaltake_sensor_read_seconds',
+                                 'time to read all subscribed temperature sensors', ('backend',))
+STREAM_FRAMES = registry.counter('thermaltake_stream_frames_total',
+                                'frames received by the stream lighting effect', ('result',))
+CONTROL_LATENCY = registry.histogram('thermaltake_control_request_seconds',
+                                     'time to handle a control socket request', ('command',))
+
+
+def is_timeout(e: Exception) -> bool:
+    return isinstance(e, TimeoutError) or getattr(e, 'errno', None) == errno.ETIMEDOUT
@@ -0,0 +1,101 @@
+import ipaddress
+import socket
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.metrics import registry
+from linux_thermaltake_rgb_plus.util import bind_unix_socket, unlink_unix_socket
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket では client_address が空文字になる
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(f'metrics: {format % args}')
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _IPv6HTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+class MetricsServer:
+    """
+    registry を Prometheus の text format で返す HTTP server.
+    listen は 'host:port' ('[::1]:port' も可) か 'unix:/path/to/socket'.
+    認証はないので host は loopback のみを受け付ける.
+    unix socket は親ディレクトリを作り, permission を mode にする.
+
+        curl http://127.0.0.1:9410/metrics
+        curl --unix-socket /run/linux_thermaltake_rgb_plus/metrics.sock http://localhost/metrics
+    """
+    DEFAULT_LISTEN = '127.0.0.1:9410'
+
+    def __init__(self, listen: str = DEFAULT_LISTEN, mode: int = 0o600):
+        self.listen = listen
+        self.mode = mode
+        if not listen.startswith('unix:'):
+            host = _split_listen(listen)[0]
+            if not _is_loopback(host):
+                raise ValueError(f'metrics listen host {host} is not a loopback address, '
+                                 f'use a unix socket to expose metrics to other users')
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if self.listen.startswith('unix:'):
+            self._server = bind_unix_socket(self.listen[len('unix:'):], self.mode,
+                                            lambda path: _UnixHTTPServer(path, _MetricsHandler))
+        else:
+            host, port = _split_listen(self.listen)
+            server_class = _IPv6HTTPServer if ':' in host else ThreadingHTTPServer
+            self._server = server_class((host, port), _MetricsHandler)
+            self._server.daemon_threads = True
+
+        self._thread = Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info(f'serving metrics on {self.listen}')
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        if self.listen.startswith('unix:'):
+            unlink_unix_socket(self.listen[len('unix:'):])
+        self._server = None
+
+
+def _split_listen(listen: str):
+    """
+    'host:port' を (host, port) にする. IPv6 の '[::1]:port' は括弧を外す. host の既定は 127.0.0.1.
+    """
+    host, _, port = listen.rpartition(':')
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    return host or '127.0.0.1', int(port)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        # 名前は解決しないと loopback か分からないので受け付けない
+        return False
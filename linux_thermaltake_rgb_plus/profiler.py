@@ -0,0 +1,164 @@
+import os
+import selectors
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from linux_thermaltake_rgb_plus import logger
+
+# 値は 1 秒あたりの sampling 回数. 'on' などの数字でない値なら DEFAULT_RATE
+ENV_PROFILE = 'LINUX_THERMALTAKE_RGB_PLUS_PROFILE'
+OUTPUT_DIR = '/tmp/linux_thermaltake_rgb_plus'
+
+# 一番内側の frame がここにあるスレッドは待っているだけなので数えない
+_IDLE_FILES = {threading.__file__, selectors.__file__}
+
+
+class SamplingProfiler:
+    """
+    sys._current_frames() で daemon のスレッド (scheduler, controller の I/O など) の stack を
+    rate 回/秒 sampling し, 同じ stack ごとに数える. dump() で flamegraph.pl や speedscope が読める
+    collapsed stack 形式のファイルを書き出す.
+    start() するまでスレッドは動かないので, 使わなければ負荷はない.
+        threads: sampling するスレッド名の prefix (None なら自分以外の全て)
+        skip_idle: lock や select で待っているだけの sample を捨てる
+    """
+    DEFAULT_RATE = 100
+
+    def __init__(self, rate: float = DEFAULT_RATE, threads=None, skip_idle: bool = True,
+                 output_dir: str = OUTPUT_DIR):
+        self.rate = rate
+        self.threads = tuple(threads) if threads else None
+        self.skip_idle = skip_idle
+        self.output_dir = output_dir
+        self.samples = 0
+        self._stacks = Counter()
+        self._started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_environ(cls):
+        """
+        環境変数 LINUX_THERMALTAKE_RGB_PLUS_PROFILE が設定されていれば profiler を作る.
+        """
+        value = os.environ.get(ENV_PROFILE)
+        if not value:
+            return None
+        try:
+            rate = float(value)
+        except ValueError:
+            rate = cls.DEFAULT_RATE
+        return cls(rate)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._main_loop, name='profiler', daemon=True)
+        self._thread.start()
+        logger.info(f'profiler sampling at {self.rate:.0f} Hz')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _main_loop(self):
+        interval = 1.0 / self.rate
+        own_ident = threading.get_ident()
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                name = names.get(ident, str(ident))
+                if self.threads is not None and not name.startswith(self.threads):
+                    continue
+                if self.skip_idle and frame.f_code.co_filename in _IDLE_FILES:
+                    continue
+                self._stacks[(name, self._stack(frame))] += 1
+            self.samples += 1
+
+            deadline += interval
+            self._stop.wait(max(0.0, deadline - time.monotonic()))
+
+    @staticmethod
+    def _stack(frame) -> tuple:
+        # 文字列にするのは dump() のときだけにして, sampling では code object を集めるだけにする
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        codes.reverse()
+        return tuple(codes)
+
+    @staticmethod
+    def _function(code) -> str:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        return f'{module}:{getattr(code, "co_qualname", code.co_name)}'
+
+    def collapsed(self) -> list:
+        """
+        'スレッド名;外側の関数;...;内側の関数 回数' の行のリストを返す.
+        """
+        lines = []
+        for (name, codes), count in self._stacks.most_common():
+            frames = ';'.join([name] + [self._function(code) for code in codes])
+            lines.append(f'{frames} {count}')
+        return lines
+
+    def top_functions(self, n: int = 10) -> list:
+        """
+        関数ごとに, 一番内側にいた回数 (self) と stack に含まれていた回数 (total) を集計する.
+        """
+        own = Counter()
+        total = Counter()
+        for (_, codes), count in self._stacks.items():
+            own[self._function(codes[-1])] += count
+            for function in {self._function(code) for code in codes}:
+                total[function] += count
+        return [(function, count, total[function]) for function, count in own.most_common(n)]
+
+    def dump(self) -> str:
+        """
+        これまでの sample を output_dir に書き出し, ファイル名を返す.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir,
+                            f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.collapsed')
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.collapsed()) + '\n')
+
+        logger.info(f'profile written to {path} ({self.samples} samples)')
+        for function, count, total in self.top_functions():
+            logger.info(f'  {function:<60} self {count:>6} total {total:>6}')
+        return path
+
+
+def install_signal_handler(daemon, signum=signal.SIGUSR1):
+    """
+    signum を受け取るたびに daemon の profiler を開始, または停止して書き出す.
+        kill -USR1 <pid>
+    """
+    def toggle(signum, frame):
+        if daemon.profiler is None:
+            daemon.profiler = SamplingProfiler()
+        if daemon.profiler.running:
+            daemon.profiler.stop()
+            # 書き出しは別スレッドで行い, signal handler はすぐに返す
+            threading.Thread(target=daemon.profiler.dump, name='profiler-dump').start()
+            daemon.profiler = None
+        else:
+            daemon.profiler.start()
+
+    signal.signal(signum, toggle)
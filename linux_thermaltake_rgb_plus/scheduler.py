@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import time
+from threading import Condition, Thread
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.metrics import TASK_LATENESS
+
+
+class FrameClock:
+    """
+    time.monotonic() 基準の絶対 deadline で frame を刻む clock.
+    処理時間の分だけ周期がずれていくことはない. deadline に間に合わなかったときは policy に従う.
+        drop: 間に合わなかった frame は飛ばし, 次の deadline に合わせる
+        catch_up: max_catch_up 個までは遅れた frame を続けて実行して追いつく. それ以上は飛ばす
+    """
+    DROP = 'drop'
+    CATCH_UP = 'catch_up'
+
+    # 遅れを記録する metrics の histogram (None なら記録しない)
+    lateness_histogram = None
+
+    def __init__(self, period: float, policy: str = DROP, max_catch_up: int = 3,
+                 deadline: float = None):
+        if policy not in (self.DROP, self.CATCH_UP):
+            raise ValueError(f'unknown frame policy {policy}')
+        self.period = period
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.deadline = time.monotonic() if deadline is None else deadline
+
+        self.frames = 0
+        self.dropped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    @property
+    def fps(self) -> float:
+        return 1.0 / self.period
+
+    @property
+    def mean_lateness(self) -> float:
+        return self.total_lateness / self.frames if self.frames else 0.0
+
+    def begin(self, now: float = None) -> float:
+        """
+        frame の開始時に呼ぶ. deadline からどれだけ遅れたか (秒) を記録して返す.
+        """
+        if now is None:
+            now = time.monotonic()
+        lateness = max(0.0, now - self.deadline)
+        self.frames += 1
+        self.last_lateness = lateness
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        if self.lateness_histogram is not None:
+            self.lateness_histogram.observe(lateness)
+        return lateness
+
+    def advance(self, now: float = None) -> float:
+        """
+        frame の終了時に呼ぶ. 次の deadline を返す.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.deadline += self.period
+        if self.deadline >= now:
+            return self.deadline
+
+        missed = int((now - self.deadline) // self.period) + 1
+        if self.policy == self.CATCH_UP:
+            # 過去の deadline のまま返せば, 遅れた frame がすぐに続けて実行される
+            missed -= self.max_catch_up
+            if missed <= 0:
+                return self.deadline
+        self.dropped += missed
+        self.deadline += missed * self.period
+        return self.deadline
+
+    def __str__(self) -> str:
+        return (f'{self.fps:.1f} fps, {self.frames} frames, {self.dropped} dropped, '
+                f'lateness mean {self.mean_lateness * 1000:.2f} ms '
+                f'max {self.max_lateness * 1000:.2f} ms')
+
+
+class ScheduledTask:
+    """
+    period 秒ごとに func を呼ぶ task. deadline は time.monotonic() 基準の次の実行時刻.
+    period が None なら 1 回だけ実行する. 周期と遅れの記録は clock (FrameClock) が持つ.
+    """
+
+    def __init__(self, func, period: float = None, deadline: float = None, name: str = None,
+                 policy: str = FrameClock.DROP):
+        self.func = func
+        self.period = period
+        self.deadline = time.monotonic() if deadline is None else deadline
+        self.name = name or getattr(func, '__qualname__', repr(func))
+        self.cancelled = False
+        self.clock = None
+        if period is not None:
+            self.clock = FrameClock(period, policy, deadline=self.deadline)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def set_period(self, period: float) -> None:
+        """
+        周期を変える. 次の deadline から新しい周期になる.
+        """
+        self.period = period
+        if self.clock is not None:
+            self.clock.period = period
+
+    def __str__(self) -> str:
+        return f'{self.name} (period {self.period}s)'
+
+
+class Scheduler:
+    """
+    fan tick, effect frame, センサの sampling などの周期処理を heap で管理し, 1 本のスレッドで実行する.
+    stop() は次の deadline を待たずにすぐ効く.
+    """
+
+    def __init__(self, name: str = 'scheduler'):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._continue = False
+        self._thread = Thread(target=self._main_loop, name=name)
+
+    def schedule(self, func, period: float = None, delay: float = 0.0,
+                 name: str = None, policy: str = FrameClock.DROP) -> ScheduledTask:
+        task = ScheduledTask(func, period, time.monotonic() + delay, name, policy)
+        if task.clock is not None:
+            task.clock.lateness_histogram = TASK_LATENESS.labels(task.name)
+        logger.debug(f'scheduling {task}')
+        self._push(task)
+        return task
+
+    def cancel(self, task: ScheduledTask) -> None:
+        task.cancel()
+        with self._cond:
+            self._cond.notify()
+
+    def start(self):
+        self._continue = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._continue = False
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _push(self, task):
+        with self._cond:
+            heapq.heappush(self._heap, (task.deadline, next(self._seq), task))
+            # 先頭が変わったかもしれないので待ち時間を計算し直させる
+            self._cond.notify()
+
+    def _pop(self):
+        """
+        次に実行する task を deadline まで待って返す. stop() されたら None を返す.
+        """
+        with self._cond:
+            while self._continue:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, _, task = self._heap[0]
+                if task.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    heapq.heappop(self._heap)
+                    return task
+                self._cond.wait(timeout)
+        return None
+
+    def _main_loop(self):
+        while True:
+            task = self._pop()
+            if task is None:
+                break
+
+            if task.clock is not None:
+                task.clock.begin()
+
+            try:
+                task.func()
+            except Exception:
+                logger.exception(f'scheduled task {task.name} failed')
+
+            if task.clock is None or task.cancelled:
+                continue
+
+            task.deadline = task.clock.advance()
+            self._push(task)
+
+        logger.debug(f'exiting {self.__class__.__name__} main loop')
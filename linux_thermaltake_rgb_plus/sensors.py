@@ -0,0 +1,244 @@
+import glob
+import os
+import time
+from collections import namedtuple
+from threading import Lock
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.metrics import SENSOR_READ
+from linux_thermaltake_rgb_plus.util import lazy_import
+
+# hwmon backend で全てのセンサが見つかれば読み込まれない
+psutil = lazy_import('psutil')
+
+SensorReading = namedtuple('SensorReading', ['current', 'timestamp'])
+
+
+class PsutilSensorBackend:
+    """
+    psutil.sensors_temperatures() を使う backend. 呼ぶたびに全ての hwmon を走査する.
+    """
+    name = 'psutil'
+
+    def __init__(self):
+        # 見つからなかったと warning を出したセンサ. 見つかるまで同じ warning は出さない
+        self._missing = set()
+
+    def subscribe(self, sensor_name: str) -> bool:
+        return True
+
+    def read(self, sensor_names) -> dict:
+        temps = psutil.sensors_temperatures()
+
+        values = {}
+        for sensor_name in sensor_names:
+            entries = temps.get(sensor_name)
+            if not entries:
+                if sensor_name not in self._missing:
+                    logger.warning(f'sensor {sensor_name} not found')
+                    self._missing.add(sensor_name)
+                continue
+            self._missing.discard(sensor_name)
+            values[sensor_name] = entries[0].current
+        return values
+
+    def close(self):
+        pass
+
+
+class HwmonSensorBackend:
+    """
+    /sys/class/hwmon を直接読む backend.
+    sensor_name (と label) に対応する tempN_input を起動時に 1 回だけ探し, fd を開いたまま pread で
+    読み直す. 見つからないセンサは psutil backend に fallback する.
+    """
+    name = 'hwmon'
+    HWMON_ROOT = '/sys/class/hwmon'
+
+    def __init__(self, labels: dict = None, root: str = HWMON_ROOT):
+        self.root = root
+        self.labels = labels or {}
+        self._fds = {}
+        self._fallback = PsutilSensorBackend()
+        self._fallback_names = set()
+        # 読めなかったと warning を出したセンサ. 読めるまで同じ warning は出さない
+        self._failed = set()
+
+    def subscribe(self, sensor_name: str) -> bool:
+        if sensor_name in self._fds or sensor_name in self._fallback_names:
+            return True
+
+        path = self._resolve(sensor_name, self.labels.get(sensor_name))
+        if path is None:
+            logger.warning(f'sensor {sensor_name} not found in {self.root}, falling back to psutil')
+            self._fallback_names.add(sensor_name)
+            return False
+
+        logger.debug(f'sensor {sensor_name} resolved to {path}')
+        self._fds[sensor_name] = os.open(path, os.O_RDONLY)
+        return True
+
+    def _resolve(self, sensor_name, label=None):
+        # psutil と同じく 'hwmonN/tempN' の辞書順で最初に見つかったものを [0] とみなす
+        bases = sorted(path[:-len('_input')]
+                       for path in glob.glob(os.path.join(self.root, 'hwmon*', 'temp*_input')))
+        for base in bases:
+            if _read_text(os.path.join(os.path.dirname(base), 'name')) != sensor_name:
+                continue
+            if label is not None and _read_text(base + '_label') != label:
+                continue
+            return base + '_input'
+        return None
+
+    def read(self, sensor_names) -> dict:
+        values = {}
+        fallback_names = []
+        for sensor_name in sensor_names:
+            fd = self._fds.get(sensor_name)
+            if fd is None:
+                fallback_names.append(sensor_name)
+                continue
+            try:
+                values[sensor_name] = int(os.pread(fd, 16, 0)) / 1000.0
+            except (OSError, ValueError) as e:
+                if sensor_name not in self._failed:
+                    logger.warning(f'failed to read sensor {sensor_name}: {e}')
+                    self._failed.add(sensor_name)
+                continue
+            self._failed.discard(sensor_name)
+
+        if fallback_names:
+            values.update(self._fallback.read(fallback_names))
+        return values
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def backend_factory(config: dict):
+    """
+    config.yml の sensors セクションから backend を作る.
+    """
+    backend = config.get('backend', 'psutil').lower()
+    if backend == 'hwmon':
+        return HwmonSensorBackend(labels=config.get('labels'))
+    elif backend != 'psutil':
+        logger.warning(f'sensor backend {backend} not found, falling back to psutil')
+    return PsutilSensorBackend()
+
+
+class SensorService:
+    """
+    温度センサの snapshot を全ての FanModel, LightingEffect で共有する.
+    定期的には読まず, get_reading() で snapshot が max_age 秒より古いときだけ全てのセンサを読み直す.
+    センサの走査は一番速く読みたい model の周期に 1 回で済み, 全ての fan が遅い周期に落ちて
+    いれば走査も減る. max_age を指定しない model は interval 秒までの snapshot を使う.
+    """
+
+    def __init__(self, interval: float = 1.0, backend=None):
+        self.interval = interval
+        self.backend = backend or PsutilSensorBackend()
+        self._sensor_names = set()
+        self._snapshot = {}
+        self._timestamp = None
+        self._lock = Lock()
+        # これまでにセンサを走査した回数
+        self.reads = 0
+
+    def subscribe(self, sensor_name: str) -> None:
+        """
+        sensor_name を sampling 対象に加える. 次の get_reading() で snapshot を読み直す.
+        model は control socket のスレッドでも作られるので, scheduler のスレッドの走査と lock で分ける.
+        """
+        with self._lock:
+            if sensor_name in self._sensor_names:
+                return
+            self._sensor_names.add(sensor_name)
+            self.backend.subscribe(sensor_name)
+            self._timestamp = None
+
+    def set_backend(self, backend) -> None:
+        """
+        backend を差し替え, subscribe 済みのセンサを新しい backend で解決し直す.
+        """
+        with self._lock:
+            self.backend.close()
+            self.backend = backend
+            for sensor_name in self._sensor_names:
+                self.backend.subscribe(sensor_name)
+            self._snapshot = {}
+            self._timestamp = None
+
+    def sample(self) -> dict:
+        """
+        subscribe されている全てのセンサを 1 回の走査で読み, snapshot を更新する.
+        """
+        with self._lock:
+            return self._sample()
+
+    def _sample(self) -> dict:
+        self.reads += 1
+        start = time.perf_counter()
+        try:
+            values = self.backend.read(tuple(self._sensor_names))
+        finally:
+            # 読めなかったセンサがあっても, 失敗しても, 次の max_age 秒は読み直さない
+            self._timestamp = timestamp = time.monotonic()
+        SENSOR_READ.labels(getattr(self.backend, 'name', type(self.backend).__name__)) \
+            .observe(time.perf_counter() - start)
+
+        snapshot = {sensor_name: SensorReading(current, timestamp)
+                    for sensor_name, current in values.items()}
+
+        self._snapshot = snapshot
+        return snapshot
+
+    def get_reading(self, sensor_name: str, max_age: float = None) -> SensorReading:
+        """
+        snapshot から sensor_name の値を返す. snapshot が max_age 秒より古ければ読み直す.
+        最後の走査で読めなかったセンサは, 次に読み直すまで KeyError になる.
+        """
+        if max_age is None:
+            max_age = self.interval
+
+        # subscribe 済みかどうかは lock を取らずに見る. 初めてのセンサだけ subscribe() で lock を取る
+        if sensor_name not in self._sensor_names:
+            self.subscribe(sensor_name)
+
+        if self._is_stale(max_age):
+            with self._lock:
+                # lock 待ちの間に他のスレッドが読み直しているかもしれない
+                if self._is_stale(max_age):
+                    self._sample()
+
+        try:
+            return self._snapshot[sensor_name]
+        except KeyError:
+            raise KeyError(f'sensor {sensor_name} not found')
+
+    def snapshot(self) -> dict:
+        """
+        最後に読んだ {sensor_name: SensorReading}. センサは読まない.
+        """
+        return self._snapshot
+
+    def get_temp(self, sensor_name: str, max_age: float = None) -> float:
+        return self.get_reading(sensor_name, max_age).current
+
+    def _is_stale(self, max_age) -> bool:
+        if self._timestamp is None:
+            return True
+        return time.monotonic() - self._timestamp > max_age
+
+
+sensor_service = SensorService()
@@ -0,0 +1,90 @@
+from threading import Lock
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.devices import ThermaltakeFanDevice
+from linux_thermaltake_rgb_plus.transport import is_disconnect
+
+
+class FanTelemetry:
+    """
+    controller ごとに全ての fan の GET_DATA を 1 回の I/O 処理にまとめて送り,
+    最新の FanSpeed を 'unit:port' ごとに snapshot として持つ.
+    snapshot を読む側は USB の往復を待たない.
+    """
+
+    def __init__(self, controllers: dict, interval: float = 1.0):
+        self.controllers = controllers
+        self.interval = interval
+        self._snapshot = {}
+        # 書き込みは controller ごとの I/O スレッドから来るので, 差し替えだけは順番に行う
+        self._lock = Lock()
+        self._in_flight = set()
+        self._task = None
+        self._scheduler = None
+
+    def start(self, scheduler):
+        self._scheduler = scheduler
+        self._task = scheduler.schedule(self.poll, self.interval, name='fan telemetry')
+
+    def stop(self):
+        if self._task is not None:
+            self._scheduler.cancel(self._task)
+            self._task = None
+
+    def poll(self):
+        """
+        各 controller の I/O スレッドに回転数の読み出しを頼む. 結果は待たない.
+        """
+        for unit, controller in self.controllers.items():
+            if unit in self._in_flight:
+                # 前回の読み出しがまだ終わっていない controller は飛ばす
+                continue
+
+            if not controller.online:
+                continue
+
+            ports = [port for port, dev in controller.devices.items()
+                     if isinstance(dev, ThermaltakeFanDevice)]
+            if not ports:
+                continue
+
+            self._in_flight.add(unit)
+            future = controller.io.call(self._read_fan_speeds, controller, ports)
+            future.add_done_callback(lambda future, unit=unit: self._on_fan_speeds(unit, future))
+
+    @staticmethod
+    def _read_fan_speeds(controller, ports):
+        # I/O スレッド上で実行される
+        fan_speeds = {}
+        for port in ports:
+            try:
+                fan_speeds[port] = controller.devices[port].read_fan_speed()
+            except Exception as e:
+                if is_disconnect(e):
+                    # I/O スレッドに controller が抜かれたことを知らせる
+                    raise
+                logger.warning(f'failed to read fan speed of {controller.unit}:{port}: {e}')
+        return fan_speeds
+
+    def _on_fan_speeds(self, unit, future):
+        self._in_flight.discard(unit)
+        if future.exception() is not None:
+            return
+
+        # 読む側が lock なしで一貫した snapshot を見られるよう, 丸ごと差し替える.
+        # 2 つの controller の結果が同時に来ても片方の更新が消えないよう, 複製から差し替えまでは lock する
+        with self._lock:
+            snapshot = dict(self._snapshot)
+            for port, fan_speed in future.result().items():
+                snapshot[f'{unit}:{port}'] = fan_speed
+            self._snapshot = snapshot
+        logger.debug(f'fan speeds {snapshot}')
+
+    def get_fan_speed(self, unit_port: str):
+        """
+        最後に読んだ 'unit:port' の FanSpeed を返す. まだ読んでいなければ None.
+        """
+        return self._snapshot.get(unit_port)
+
+    def snapshot(self) -> dict:
+        return self._snapshot
@@ -0,0 +1,319 @@
+import errno
+import math
+import os
+import random
+import time
+from array import array
+from collections import deque
+
+import usb
+
+from linux_thermaltake_rgb_plus import logger
+from linux_thermaltake_rgb_plus.globals import TT_RGB_PLUS, PACKET_LENGTH
+from linux_thermaltake_rgb_plus.globals \
+    import PROTOCOL_GET, PROTOCOL_SET, PROTOCOL_FAN, PROTOCOL_LIGHT
+
+# config.yml の transport セクションより優先される
+ENV_TRANSPORT = 'LINUX_THERMALTAKE_RGB_PLUS_TRANSPORT'
+
+STATUS_SUCCESS = 0xfc
+STATUS_FAIL = 0xfe
+
+
+class UsbTransport:
+    """
+    pyusb で実機の controller と読み書きする transport.
+    """
+    name = 'usb'
+
+    def __init__(self, devices: dict = None):
+        # enumerate_devices() で見つけておいた {product_id: device}
+        self.devices = devices or {}
+        self.device = None
+        self.endpoint_out = None
+        self.endpoint_in = None
+
+    def open(self, vendor_id: int, product_id: int) -> None:
+        self.device = self.devices.get(product_id)
+        if self.device is None:
+            self.device = usb.core.find(idVendor=vendor_id, idProduct=product_id)
+        if self.device is None:
+            raise ValueError('Device not found')
+
+        # 最後のデバイスの利用の仕方が汚いと安全性が損なわれるので, 一度resetする.
+        try:
+            self.device.reset()
+        except usb.core.USBError as e:
+            logger.error('usb device access denied (insufficient permissions)')
+            raise e
+
+        # linux kernel はUSBデバイスがポートに挿入されたとき, 自動的にデバイスに対してデバイスドライ
+        # バを関連付けてくれる. しかし, そのせいで他のデバイスドライバがUSBデバイスに対してアクセス
+        # できなくなってしまう. そこで, 一度 detach する.
+        try:
+            self.device.detach_kernel_driver(0)
+        except Exception:
+            logger.warning('kernel driver already detached')
+
+        # 使うためのconfigurationをアクティブにする. (引数なしはfirst configurationを選ぶことになる)
+        self.device.set_configuration()
+
+        # usbデバイスのinterfaceの所有権を取得したいことをlinux kernelに宣言するために, interface を
+        # 要求する.
+        try:
+            usb.util.claim_interface(self.device, 0)
+        except usb.core.USBError as e:
+            logger.error('{} while claiming interface for device'.format(e))
+            raise e
+
+        # たぶん, configurationディスクリプタの取得要求. configurationディスクリプタの取得要求に対し
+        # て, interfaceディスクリプタとendpointディスクリプタも合わせて戻す使用になっていることが一
+        # 般的なので, 次の行でinterfaceディスクリプタが戻されていると思われる.
+        cfg = self.device.get_active_configuration()
+        interface = cfg[(0, 0)]
+
+        # 出力方向のエンドポイントを取得.
+        self.endpoint_out = usb.util.find_descriptor(
+                interface,
+                custom_match=lambda e:
+                    usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        assert self.endpoint_out is not None
+
+        # 入力方向のエンドポイントを取得.
+        self.endpoint_in = usb.util.find_descriptor(
+                interface,
+                custom_match=lambda e:
+                    usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+        assert self.endpoint_in is not None
+
+    def write(self, data) -> None:
+        self.endpoint_out.write(data)
+
+    def read(self, length: int = PACKET_LENGTH):
+        return self.endpoint_in.read(length)
+
+    def close(self) -> None:
+        if self.device is not None:
+            usb.util.dispose_resources(self.device)
+            self.device = None
+            # 抜き差しされると起動時に見つけた device は使えないので, 次の open では探し直す
+            self.devices = {}
+
+
+class SimulatedController:
+    """
+    TT_RGB_PLUS protocol を話す controller の模擬.
+    INIT, SET_RGB, SET_SPEED, GET_DATA, GET_FIRMWARE_VERSION, SAVE_PROFILE に応答し,
+    fan の回転数は duty に向かって spinup 秒の時定数で近づく.
+    応答は max_replies 個までしか溜めず, 読まれなかった古いものから捨てる.
+    """
+    FIRMWARE_VERSION = (1, 0, 0)
+
+    def __init__(self, product_id: int, ports: int = 5, max_rpm: int = 1500,
+                 spinup: float = 2.0, rpm_noise: float = 0.01, max_replies: int = 1,
+                 rng: random.Random = None, clock=time.monotonic):
+        self.product_id = product_id
+        self.ports = ports
+        self.max_rpm = max_rpm
+        self.spinup = spinup
+        self.rpm_noise = rpm_noise
+        self.rng = rng or random.Random()
+        self.clock = clock
+
+        self.initialized = False
+        self.lighting = {}
+        self.speeds = {port: 0 for port in range(1, ports + 1)}
+        self.saved_profile = None
+        self.replies = deque(maxlen=max_replies)
+
+        self._rpms = {port: 0.0 for port in range(1, ports + 1)}
+        self._updated = clock()
+
+    def handle(self, packet) -> None:
+        """
+        書き込まれた packet を処理し, 応答を溜める.
+        """
+        command = (packet[0], packet[1])
+        if command == tuple(TT_RGB_PLUS.COMMAND.INIT):
+            self.initialized = True
+            self._reply(packet[0], packet[1], STATUS_SUCCESS)
+        elif command == tuple(TT_RGB_PLUS.COMMAND.GET_FIRMWARE_VERSION):
+            self._reply(packet[0], packet[1], *self.FIRMWARE_VERSION)
+        elif command == (PROTOCOL_SET, PROTOCOL_LIGHT) and self._valid_port(packet[2]):
+            self.lighting[packet[2]] = (packet[3], bytes(packet[4:]))
+            self._reply(packet[0], packet[1], STATUS_SUCCESS)
+        elif command == (PROTOCOL_SET, PROTOCOL_FAN) and self._valid_port(packet[2]):
+            self._update_rpms()
+            self.speeds[packet[2]] = min(packet[4], 100)
+            self._reply(packet[0], packet[1], STATUS_SUCCESS)
+        elif command == (PROTOCOL_GET, PROTOCOL_FAN) and self._valid_port(packet[2]):
+            self._update_rpms()
+            port = packet[2]
+            rpm = int(self._rpms[port])
+            self._reply(packet[0], packet[1], port, 0x01, self.speeds[port], rpm & 0xff, rpm >> 8)
+        elif command == tuple(TT_RGB_PLUS.COMMAND.SAVE_PROFILE):
+            self.saved_profile = dict(self.lighting)
+            self._reply(packet[0], packet[1], STATUS_SUCCESS)
+        else:
+            logger.debug(f'simulated controller {self.product_id:#x}: '
+                         f'unknown command {list(packet[:4])}')
+            self._reply(packet[0], packet[1], STATUS_FAIL)
+
+    def _valid_port(self, port) -> bool:
+        return 1 <= port <= self.ports
+
+    def _reply(self, *values) -> None:
+        self.replies.append(bytes(values))
+
+    def _update_rpms(self) -> None:
+        now = self.clock()
+        decay = math.exp(-(now - self._updated) / self.spinup) if self.spinup > 0 else 0.0
+        self._updated = now
+        for port, speed in self.speeds.items():
+            target = self.max_rpm * speed / 100
+            noise = self.rng.gauss(0, self.rpm_noise * target) if target else 0.0
+            rpm = target + (self._rpms[port] - target) * decay + noise
+            self._rpms[port] = min(max(rpm, 0.0), 0xffff)
+
+
+class SimulatedTransport:
+    """
+    SimulatedController と読み書きする transport. 実機なしでの試験と負荷試験用.
+        latency: 1 回の転送にかかる時間 (秒)
+        jitter: latency に足す一様乱数の幅 (秒)
+        failure_rate: 転送が IOError で失敗する確率
+        timeout: 応答がないときに read が待つ時間 (秒)
+        open_latency: open (実機の reset, detach, claim にあたる) にかかる時間 (秒)
+    unplug() から plug() までは, 抜かれた実機と同じく全ての転送と open が ENODEV で失敗する.
+    """
+    name = 'simulated'
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0,
+                 timeout: float = 0.0, open_latency: float = 0.0, seed: int = None,
+                 **controller_kwargs):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout = timeout
+        self.open_latency = open_latency
+        self.rng = random.Random(seed)
+        self.controller_kwargs = controller_kwargs
+        self.controller = None
+        self.connected = True
+
+        self.writes = 0
+        self.reads = 0
+        self.failures = 0
+
+    def open(self, vendor_id: int, product_id: int) -> None:
+        if not self.connected:
+            raise ValueError('Device not found')
+        time.sleep(self.open_latency)
+        self._delay()
+        self.controller = SimulatedController(product_id, rng=self.rng, **self.controller_kwargs)
+        logger.info(f'using simulated controller {vendor_id:#06x}:{product_id:#06x}')
+
+    def write(self, data) -> None:
+        self._transfer()
+        self.writes += 1
+        self.controller.handle(data)
+
+    def read(self, length: int = PACKET_LENGTH):
+        self._check_connected()
+        if not self.controller.replies:
+            time.sleep(self.timeout)
+            self.failures += 1
+            raise TimeoutError('simulated read timed out')
+
+        self._transfer()
+        self.reads += 1
+        reply = array('B', self.controller.replies.popleft())
+        reply.extend(bytes(length - len(reply)))
+        return reply
+
+    def close(self) -> None:
+        self.controller = None
+
+    def unplug(self) -> None:
+        self.connected = False
+
+    def plug(self) -> None:
+        # 挿し直された controller は INIT されるまで何も覚えていない
+        self.connected = True
+
+    def _check_connected(self) -> None:
+        if not self.connected:
+            self.failures += 1
+            raise OSError(errno.ENODEV, 'No such device (simulated unplug)')
+
+    def _delay(self) -> None:
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _transfer(self) -> None:
+        self._check_connected()
+        self._delay()
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            self.failures += 1
+            raise IOError('simulated transfer failure')
+
+
+# libusb の LIBUSB_ERROR_NO_DEVICE
+_LIBUSB_ERROR_NO_DEVICE = -4
+
+
+def is_disconnect(e: Exception) -> bool:
+    """
+    controller が抜かれた (または reset されて handle が無効になった) ことによる失敗か.
+    """
+    return (getattr(e, 'errno', None) in (errno.ENODEV, errno.ENOENT) or
+            getattr(e, 'backend_error_code', None) == _LIBUSB_ERROR_NO_DEVICE)
+
+
+_config = {}
+
+
+def configure(config: dict) -> None:
+    """
+    config.yml の transport セクションを以降に作る transport の既定値にする.
+    """
+    global _config
+    _config = dict(config or {})
+
+
+def _options(config: dict = None):
+    options = dict(_config if config is None else config)
+    backend = os.environ.get(ENV_TRANSPORT) or options.get('backend', 'usb')
+    # transport 自体の設定ではない項目
+    for key in ('backend', 'startup_timeout'):
+        options.pop(key, None)
+    return backend.lower(), options
+
+
+def enumerate_devices(vendor_id: int, config: dict = None) -> dict:
+    """
+    bus を 1 回だけ走査し, vendor_id の device を {product_id: device} で返す.
+    controller ごとに usb.core.find で bus 全体を走査しないよう, 結果を transport_factory に渡す.
+    """
+    backend, _ = _options(config)
+    if backend != UsbTransport.name:
+        return {}
+    return {device.idProduct: device
+            for device in usb.core.find(find_all=True, idVendor=vendor_id)}
+
+
+def transport_factory(config: dict = None, devices: dict = None):
+    """
+    transport を作る. 環境変数 LINUX_THERMALTAKE_RGB_PLUS_TRANSPORT があれば backend はそれに従う.
+    devices は enumerate_devices() の結果.
+    """
+    backend, options = _options(config)
+
+    if backend == SimulatedTransport.name:
+        return SimulatedTransport(**options)
+    elif backend != UsbTransport.name:
+        logger.warning(f'transport {backend} not found, falling back to usb')
+    return UsbTransport(devices)
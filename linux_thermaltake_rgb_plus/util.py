@@ -1,3 +1,11 @@
+import errno
+import importlib.util
+import os
+import socket
+import stat
+import sys
+
+
 def flatten_list(l):
     for el in l:
         if isinstance(el, list):
@@ -5,3 +13,83 @@ def flatten_list(l):
         else:
             yield el
 
+
+def lazy_import(name: str):
+    """
+    module を属性に初めて触れたときに読み込む. numpy のような重い module を, config がそれを使う
+    model を含むときにだけ読み込むために使う.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def parse_mode(mode) -> int:
+    """
+    YAML の 0660 は 8 進数の int になるが, '660' のような文字列も受け付ける.
+    """
+    return int(mode, 8) if isinstance(mode, str) else int(mode)
+
+
+def bind_unix_socket(path: str, mode, bind):
+    """
+    親ディレクトリを作り, 前回の socket が残っていれば消してから bind(path) を呼び, socket の
+    permission を mode にする. bind の戻り値を返す.
+    path で誰か (別の manager や別の daemon) が待ち受けている場合と, path が socket でない場合は
+    消さずに OSError にする.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        pass
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            raise OSError(errno.EEXIST, f'{path} exists and is not a socket')
+        if _unix_socket_in_use(path):
+            raise OSError(errno.EADDRINUSE, f'{path} is already in use')
+        os.unlink(path)
+    result = bind(path)
+    os.chmod(path, parse_mode(mode))
+    return result
+
+
+def _unix_socket_in_use(path: str) -> bool:
+    # stream と datagram のどちらで待ち受けているかは分からないので両方で繋いでみる.
+    # 前回の socket が残っているだけなら ECONNREFUSED になる
+    for type in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+        with socket.socket(socket.AF_UNIX, type) as sock:
+            sock.settimeout(0.5)
+            try:
+                sock.connect(path)
+            except socket.timeout:
+                # backlog が詰まっているだけで, 待ち受けてはいる
+                return True
+            except OSError as e:
+                if e.errno == errno.EPROTOTYPE:
+                    continue
+                return False
+            return True
+    return False
+    result = bind(path)
+    os.chmod(path, parse_mode(mode))
+    return result
+
+
+def unlink_unix_socket(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass